@@ -0,0 +1,478 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Offline benchmarks for liqudityPoolTool: parsing, scraping, pool math and appends.
+Run: python benchmarks.py [--quick] [--out results.json] [--compare old.json]
+Results are saved as json, so runs on different commits can be compared with --compare.
+'''
+
+import os, sys
+import json
+import random
+import platform
+import statistics
+import subprocess
+import tempfile
+import threading
+import importlib.util
+import http.server
+from time import sleep, perf_counter
+from datetime import datetime
+import numpy as np
+
+import liqudityPoolTool as lpt
+
+
+# Sizes of the full run and of a --quick run
+SIZES = {
+    'full':  {'pairs': [10, 1000, 100000, 1000000], 'rows': [0, 10000, 100000, 1000000],
+              'tokens': 100, 'workers': [1, 4, 16], 'repeat': 5},
+    'quick': {'pairs': [10, 1000, 100000], 'rows': [0, 10000],
+              'tokens': 20, 'workers': [1, 4], 'repeat': 3}
+    }
+
+# Creates html of a token page as extractTokenMetrics() expects it (padded to about {padKb} kB like a real page)
+def fixtureTokenPage(symbol, price, tableRows=30, padKb=40):
+    '''
+    Returns str of a synthetic 'coingecko.com/en/coins/{token}' page with 14 'no-wrap' spans,
+    7 'mt-1' divs and a table of {tableRows} rows including 'Market Cap Rank'.
+    '''
+    spans = [
+        f'<span class="no-wrap" data-price-btc="{price / 50000}" data-coin-symbol="{symbol}">${price:,.2f}</span>',
+        f'<span class="no-wrap" data-price-btc="{price * 20}">${price * 1e6:,.0f}</span>'
+        ]
+    spans += [f'<span class="no-wrap">${price * (i + 1):,.2f}</span>' for i in range(2, 14)]
+    divs = ''.join(f'<div class="mt-1">x{i}</div>' for i in range(6)) + '<div class="mt-1">18,000,000 / ∞</div>'
+    rows = [f'<tr><th>Metric {i}</th><td>${i * price:,.2f}</td></tr>' for i in range(tableRows - 1)]
+    rows.insert(tableRows // 2, '<tr><th>Market Cap Rank</th><td>#12</td></tr>')
+
+    # Markup the parser has to skip, like scripts, menus and charts on the real page
+    filler = '<div class="nav"><a href="/en/coins/x">Link</a><!-- c --><span>text &amp; more</span></div>\n'
+    padding = filler * (padKb * 1024 // len(filler))
+
+    return (f'<html><head><script>var x = "<tr>";</script></head><body>{padding}<div>{"".join(spans)}</div>'
+            f'{divs}<table>{"".join(rows)}</table>{padding}</body></html>')
+
+# Creates html of a listing page ('coingecko.com/en?page={page}') as metricsFromRow() expects it
+def fixtureListingPage(page, nRows=100):
+    '''
+    Returns str of a synthetic listing page with {nRows} coins. Rank 1 is BTC.
+    '''
+    rng = random.Random(page)
+    rows = ['<table><tr><th>#</th></tr>']
+    for k in range(nRows):
+        rank = (page - 1) * nRows + k + 1
+        symbol = 'BTC' if rank == 1 else f'C{rank}'
+        price = 50000.0 if rank == 1 else rng.random() * 100
+        rows.append(
+            f'<tr>\n<td>*</td>\n<td>{rank}</td>\n<td>\n<div>\nName{rank}\n{symbol}\n\n\n</div></td>\n'
+            f'<td>${price:,.4f}</td>\n<td>{rng.random():.1f}%</td>\n<td>{rng.random():.1f}%</td>\n'
+            f'<td>-{rng.random():.1f}%</td>\n<td>${rng.random() * 1e6:,.0f}</td>\n<td>${price * 1e6:,.0f}</td>\n</tr>'
+            )
+    rows.append('</table>')
+    return '<html><body>' + ''.join(rows) + '</body></html>'
+
+# Returns recorded pages from a PageArchive (latest fetch per token / listing page)
+def loadArchivedPages(root):
+    '''
+    Assumes the directory of a PageArchive (i.e. written with 'liqudityPoolTool.py scrape --archive').
+    Returns (tokenPages, listingPages): dict {tokenStr: bytes} and list of bytes.
+    '''
+    archive = lpt.PageArchive(root)
+    latest = {}
+    for _, _, kind, key, digest in archive.entries():
+        latest[(kind, key)] = digest
+    tokenPages = {key: archive.get(digest) for (kind, key), digest in latest.items() if kind == 'token'}
+    listingPages = [archive.get(digest) for (kind, key), digest in latest.items() if kind == 'listing']
+    archive.close()
+    return tokenPages, listingPages
+
+# Returns synthetic pages: (dict {tokenStr: bytes}, list of bytes), same shape as loadArchivedPages()
+def fixturePages(nTokens=20, nListingPages=3):
+    tokenPages = {f'tok{i}': fixtureTokenPage(f'T{i}', 10.0 + i).encode() for i in range(nTokens)}
+    listingPages = [fixtureListingPage(page).encode() for page in range(1, nListingPages + 1)]
+    return tokenPages, listingPages
+
+# Runs func {repeat} x {number} times and returns dict of seconds per call (median, best)
+def measure(func, repeat=5, number=1):
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        for _ in range(number):
+            func()
+        times.append((perf_counter() - start) / number)
+    return {'median': statistics.median(times), 'best': min(times), 'repeat': repeat, 'number': number}
+
+# Helper function: Returns one result record, with throughput = {items} per median second
+def _record(name, params, timing, items=None, unit=None):
+    record = {'name': name, 'params': params}
+    record.update(timing)
+    if items is not None:
+        record['throughput'] = items / timing['median']
+        record['unit'] = unit
+    print(f"{name:<28} {json.dumps(params):<40} {timing['median'] * 1000:>12.3f} ms"
+          + (f"  {record['throughput']:>14,.1f} {unit}" if items is not None else ''))
+    return record
+
+# Parse throughput: extractTokenMetrics() per backend, listing rows, findCell() vs. RowIndex
+def benchParse(tokenPages, listingPages, repeat=5):
+    '''
+    Returns list of result records. Uses every backend in lpt.EXTRACTORS that can be imported.
+    '''
+    results = []
+    pages = list(tokenPages.items())
+    megabytes = sum(len(html) for _, html in pages) / 1e6
+    extractors = [name for name in lpt.EXTRACTORS if name != 'bs4' or importlib.util.find_spec('bs4')]
+
+    for extractor in extractors:
+        timing = measure(lambda: [lpt.extractTokenMetrics(html, tokenStr, extractor=extractor)
+                                  for tokenStr, html in pages], repeat)
+        results.append(_record('parse.tokenPage', {'extractor': extractor, 'pages': len(pages)},
+                               timing, len(pages), 'pages/s'))
+        results[-1]['mbPerSecond'] = megabytes / timing['median']
+
+    # Listing pages: extract rows, scrape every row
+    def parseListing():
+        for html in listingPages:
+            for row in lpt.extractTags(html, {'rows': ('tr', None)})['rows'][1:]:
+                lpt.metricsFromRow(row)
+    nRows = sum(len(lpt.extractTags(html, {'rows': ('tr', None)})['rows']) - 1 for html in listingPages)
+    results.append(_record('parse.listing', {'pages': len(listingPages)}, measure(parseListing, repeat),
+                           nRows, 'rows/s'))
+
+    # Table lookups on one page: rescan per lookup vs. building the index and looking up once
+    tableRows = lpt.extractTags(pages[0][1], {'rows': ('tr', None)})['rows']
+    results.append(_record('parse.findCell', {'rows': len(tableRows)},
+                           measure(lambda: lpt.findCell(tableRows, 'Market Cap Rank'), repeat, 100),
+                           1, 'lookups/s'))
+    results.append(_record('parse.rowIndex', {'rows': len(tableRows)},
+                           measure(lambda: lpt.RowIndex(tableRows).cell('Market Cap Rank', stripToInt=True),
+                                   repeat, 100),
+                           1, 'lookups/s'))
+    return results
+
+# Local stand-in for coingecko: serves pages from memory after {latency} seconds
+class FixtureServer:
+    '''
+    Context manager. Serves pages {path: bytes} (i.e. '/en/coins/tok0') on a free local port,
+    each response delayed by {latency} seconds. baseUrl replaces lpt.BASE_URL.
+    '''
+    def __init__(self, pages, latency=0.05):
+        self.pages = pages
+        self.latency = latency
+
+    def __enter__(self):
+        pages, latency = self.pages, self.latency
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                sleep(latency)
+                body = pages.get(self.path)
+                if body is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.baseUrl = f'http://127.0.0.1:{self.server.server_address[1]}/en'
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+# createMetricsDict() against the local stand-in, for several numbers of workers
+def benchScrape(tokenPages, nTokens=100, workersList=(1, 4, 16), latency=0.05, repeat=3):
+    '''
+    Serves the token pages (repeated to get {nTokens} tokens) with {latency} seconds delay
+    and times createMetricsDict() on pools of these tokens. The rate limit is set high
+    enough to not be the bottleneck, the token cache is cleared before every run.
+    '''
+    htmls = list(tokenPages.values())
+    pages = {f'/en/coins/tok{i}': htmls[i % len(htmls)] for i in range(nTokens)}
+    pools = {f'pair{i}': {'colStr': f'tok{2 * i}', 'assStr': f'tok{2 * i + 1}'} for i in range(nTokens // 2)}
+
+    results = []
+    baseUrl, archive = lpt.BASE_URL, lpt.PAGE_ARCHIVE
+    with FixtureServer(pages, latency) as server:
+        lpt.BASE_URL, lpt.PAGE_ARCHIVE = server.baseUrl, None
+        try:
+            for workers in workersList:
+                def scrape():
+                    lpt.TOKEN_CACHE.clear()
+                    metrics = lpt.createMetricsDict(pools, verbose=False, workers=workers,
+                                                    rateLimit=1e6, burst=workers)
+                    assert len(metrics) == nTokens, 'benchScrape(): Not all tokens were scraped.'
+                timing = measure(scrape, repeat)
+                results.append(_record('scrape.createMetricsDict',
+                                       {'tokens': nTokens, 'workers': workers, 'latency': latency},
+                                       timing, nTokens, 'tokens/s'))
+        finally:
+            lpt.BASE_URL, lpt.PAGE_ARCHIVE = baseUrl, archive
+            lpt.TOKEN_CACHE.clear()
+    return results
+
+# Creates a PoolTable of {nPairs} random pairs with prices (same seed, same portfolio)
+def syntheticPortfolio(nPairs, seed=0):
+    rng = np.random.default_rng(seed)
+    nTokens = min(nPairs + 1, 1000)
+    colId = rng.integers(0, nTokens, nPairs)
+    assId = (colId + rng.integers(1, nTokens, nPairs)) % nTokens
+    table = lpt.PoolTable(
+        [f'pair{i}' for i in range(nPairs)],
+        {'colId': colId, 'assId': assId,
+         'numColEntry': rng.uniform(0.1, 10, nPairs), 'numAssEntry': rng.uniform(100, 10000, nPairs)},
+        [f'tok{i}' for i in range(nTokens)]
+        )
+    return table.setPrices(rng.lognormal(3, 2, nTokens))
+
+# Pool math on synthetic portfolios: getPoolStatus() on tables and dicts, balancePools() on arrays
+def benchPoolMath(sizes=(10, 1000, 100000, 1000000), repeat=5, maxDictPairs=100000):
+    '''
+    Returns list of result records. The dict path (nested dicts in and out) is only timed
+    up to {maxDictPairs} pairs.
+    '''
+    results = []
+    for nPairs in sizes:
+        table = syntheticPortfolio(nPairs)
+        c = table.columns
+        params = {'pairs': nPairs}
+
+        results.append(_record('pools.balancePools', params, measure(
+            lambda: lpt.balancePools(c['numColEntry'], c['priceCol'], c['numAssEntry'], c['priceAss']), repeat),
+            nPairs, 'pairs/s'))
+        results.append(_record('pools.getPoolStatus.table', params,
+                               measure(lambda: lpt.getPoolStatus(table), repeat), nPairs, 'pairs/s'))
+        if nPairs <= maxDictPairs:
+            data = table.toDict()
+            results.append(_record('pools.getPoolStatus.dict', params,
+                                   measure(lambda: lpt.getPoolStatus(data), repeat), nPairs, 'pairs/s'))
+    return results
+
+# Append cost at growing file sizes: csv (warm and cold state) and HistoryStore
+def benchAppend(sizes=(0, 10000, 100000, 1000000), batch=10, repeat=5, directory=None):
+    '''
+    Grows a csv and a HistoryStore to each size in {sizes} (rows), then times appending one
+    update of {batch} rows. 'cold' forgets the cached header/last id first, like a new process.
+    Files are written to {directory} (default: a temporary directory, removed afterwards).
+    '''
+    results = []
+    varNames = ['token', 'poolValue', 'amtCol', 'amtAss']
+    rows = [[f'pair{i}', 1000.0 + i, 1.5, 3000.0] for i in range(batch)]
+
+    with tempfile.TemporaryDirectory(dir=directory) as tmpDir:
+        fileName = os.path.join(tmpDir, 'history.csv')
+        store = lpt.HistoryStore(os.path.join(tmpDir, 'history.db'))
+        size = 0
+
+        for target in sorted(sizes):
+            # Grow both files to {target} rows in large chunks
+            while size < target:
+                n = min(100000, target - size)
+                fill = [[f'pair{i % 1000}', 1000.0, 1.5, 3000.0] for i in range(n)]
+                lpt.appendRows(fileName, fill, varNames, verbose=False)
+                store.append(fill, varNames)
+                size += n
+
+            params = {'rows': target, 'batch': batch}
+
+            def coldAppend():
+                lpt._csvState.clear()
+                lpt.appendRows(fileName, rows, varNames, verbose=False)
+
+            results.append(_record('append.csv', params, measure(
+                lambda: lpt.appendRows(fileName, rows, varNames, verbose=False), repeat), batch, 'rows/s'))
+            results.append(_record('append.csv.cold', params, measure(coldAppend, repeat), batch, 'rows/s'))
+            results.append(_record('append.historyStore', params, measure(
+                lambda: store.append(rows, varNames), repeat), batch, 'rows/s'))
+            size += 3 * repeat * batch
+
+        store.close()
+    return results
+
+# Import time allowed for the 'status' command (seconds, see measureStatusImports())
+STATUS_IMPORT_BUDGET = 0.5
+
+# Runs the status command in fresh interpreters and returns the median import time and heavy modules loaded
+def measureStatusImports(runs=3):
+    '''
+    Runs main(['status', pools, '--prices', prices, '--csv', csv]) on a one-pair portfolio
+    in {runs} new Python processes with '-X importtime'. Imports done while the command
+    runs (lazy imports) are counted too.
+    Returns dict: 'seconds' (median of the runs), 'runs' (list of seconds), and 'heavy'
+    (those of pandas, matplotlib, bs4 that were imported).
+    '''
+    moduleName = lpt.__name__
+    times, heavy = [], set()
+    with tempfile.TemporaryDirectory() as tmpDir:
+        pools, prices = os.path.join(tmpDir, 'pools.json'), os.path.join(tmpDir, 'prices.json')
+        with open(pools, 'w') as file:
+            json.dump({'ETH-DAI': {'colStr': 'ethereum', 'assStr': 'dai', 'numColEntry': 1.0,
+                                   'numAssEntry': 2000.0}}, file)
+        with open(prices, 'w') as file:
+            json.dump({'ethereum': 2000.0, 'dai': 1.0}, file)
+        argv = ['status', pools, '--prices', prices, '--csv', os.path.join(tmpDir, 'status.csv')]
+        code = (f'import sys, argparse, {moduleName}; {moduleName}.main({argv!r}); '
+                "print('heavy:' + ','.join(m for m in ('pandas', 'matplotlib', 'bs4') if m in sys.modules))")
+
+        for _ in range(runs):
+            result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True,
+                                    text=True, cwd=os.path.dirname(os.path.abspath(lpt.__file__)), check=True)
+
+            # Sum cumulative times (us) of top-level imports (lines 'import time: self | cumulative | name')
+            seconds = 0.0
+            for line in result.stderr.splitlines():
+                fields = line.split('|')
+                if line.startswith('import time:') and len(fields) == 3 and not fields[2].startswith('  '):
+                    try:
+                        seconds += int(fields[1]) / 1e6
+                    except ValueError:
+                        continue
+            times.append(seconds)
+            heavyLine = [line for line in result.stdout.splitlines() if line.startswith('heavy:')][-1]
+            heavy.update(m for m in heavyLine[len('heavy:'):].split(',') if m)
+
+    return {'seconds': statistics.median(times), 'runs': times, 'heavy': sorted(heavy)}
+
+# Import time of the 'status' command (see measureStatusImports()), checked against its budget
+def benchImports(runs=3):
+    result = measureStatusImports(runs)
+    withinBudget = not result['heavy'] and result['seconds'] < STATUS_IMPORT_BUDGET
+    print(f"{'imports.status':<28} {result['seconds']:.3f} s (budget {STATUS_IMPORT_BUDGET} s)"
+          + ('' if withinBudget else f"  OVER BUDGET, heavy imports: {result['heavy']}"))
+    return [{'name': 'imports.status', 'params': {'budget': STATUS_IMPORT_BUDGET},
+             'median': result['seconds'], 'best': min(result['runs']), 'repeat': runs,
+             'heavy': result['heavy'], 'withinBudget': withinBudget}]
+
+# Returns dict describing the environment of a run (commit, versions, machine)
+def environment():
+    def git(*args):
+        try:
+            return subprocess.run(['git', *args], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                  capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+    return {
+        'commit': git('rev-parse', 'HEAD'),
+        'dirty': bool(git('status', '--porcelain', '--untracked-files=no')),
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count()
+        }
+
+# Compares two result files and returns the benchmarks that got slower by more than {threshold}
+def compareResults(old, new, threshold=0.1):
+    '''
+    Assumes two result dicts as saved by runBenchmarks(). Matches benchmarks by name and params,
+    compares median seconds and prints one line per benchmark.
+    Returns list of (name, params, oldMedian, newMedian) of regressions.
+    '''
+    key = lambda record: (record['name'], json.dumps(record['params'], sort_keys=True))
+    oldRecords = {key(record): record for record in old['results']}
+    regressions = []
+
+    print(f"\n{old['environment'].get('commit')} -> {new['environment'].get('commit')}")
+    for record in new['results']:
+        # Possibility: A budget is broken. That's a regression no matter what the old run says.
+        if record.get('withinBudget') is False:
+            print(f"{record['name']:<28} {json.dumps(record['params']):<40} over budget")
+            regressions.append((record['name'], record['params'], None, record['median']))
+            continue
+
+        before = oldRecords.get(key(record))
+        if not before or not before['median'] or not record['median']:
+            continue
+        change = record['median'] / before['median'] - 1
+        flag = 'SLOWER' if change > threshold else ('faster' if change < -threshold else '')
+        print(f"{record['name']:<28} {json.dumps(record['params']):<40} {change:>+8.1%}  {flag}")
+        if change > threshold:
+            regressions.append((record['name'], record['params'], before['median'], record['median']))
+    return regressions
+
+# Runs the selected benchmarks and saves all results to a json file
+def runBenchmarks(outFile, only=None, quick=False, pagesDir=None, latency=0.05):
+    '''
+    only:     List of groups to run ('parse', 'scrape', 'pools', 'append', 'imports'). Default: all.
+    quick:    Smaller sizes (see SIZES), i.e. for a check before every commit.
+    pagesDir: PageArchive with recorded pages to parse and serve. Default: synthetic fixture pages.
+    Returns the result dict: {'environment': {...}, 'results': [record, ...]}.
+    '''
+    sizes = SIZES['quick' if quick else 'full']
+    only = set(only or ['parse', 'scrape', 'pools', 'append', 'imports'])
+    tokenPages, listingPages = loadArchivedPages(pagesDir) if pagesDir else fixturePages()
+    assert tokenPages, f'runBenchmarks(): No token pages found in {pagesDir}.'
+    if not listingPages:
+        listingPages = fixturePages(nTokens=0)[1]
+
+    results = []
+    if 'parse' in only:
+        results += benchParse(tokenPages, listingPages, repeat=sizes['repeat'])
+    if 'scrape' in only:
+        results += benchScrape(tokenPages, nTokens=sizes['tokens'], workersList=sizes['workers'],
+                               latency=latency, repeat=min(3, sizes['repeat']))
+    if 'pools' in only:
+        results += benchPoolMath(sizes['pairs'], repeat=sizes['repeat'])
+    if 'append' in only:
+        results += benchAppend(sizes['rows'], repeat=sizes['repeat'])
+    if 'imports' in only:
+        results += benchImports()
+
+    env = environment()
+    env.update({'quick': quick, 'pages': pagesDir or 'fixtures', 'latency': latency})
+    output = {'environment': env, 'results': results}
+    with open(outFile, 'w') as file:
+        json.dump(output, file, indent=1)
+    print(f'\nSaved {len(results)} results to {outFile}.')
+    return output
+
+# Command line interface: python benchmarks.py [--quick] [--only ...] [--out FILE] [--compare OLD]
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Offline benchmarks of liqudityPoolTool.')
+    parser.add_argument('--out', help='json file for the results (default: benchmark-{commit}.json)')
+    parser.add_argument('--quick', action='store_true', help='smaller sizes, fewer repeats')
+    parser.add_argument('--only', nargs='+', choices=['parse', 'scrape', 'pools', 'append', 'imports'],
+                        help='run only these groups')
+    parser.add_argument('--pages', help='PageArchive directory with recorded pages (default: fixtures)')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per request of the stand-in')
+    parser.add_argument('--compare', help='earlier result file to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown reported as regression (default: 0.1 = 10%%)')
+    args = parser.parse_args(argv)
+
+    outFile = args.out or f"benchmark-{(environment()['commit'] or 'nocommit')[:7]}.json"
+    output = runBenchmarks(outFile, only=args.only, quick=args.quick, pagesDir=args.pages,
+                           latency=args.latency)
+
+    # Option: Compare with an earlier run, exit with 1 if anything got slower
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            regressions = compareResults(json.load(file), output, args.threshold)
+        if regressions:
+            print(f'{len(regressions)} regression(s) above {args.threshold:.0%} or over budget.')
+            sys.exit(1)
+
+    # Possibility: A budget is broken (i.e. status imports pandas). Fail even without --compare.
+    overBudget = [record['name'] for record in output['results'] if record.get('withinBudget') is False]
+    if overBudget:
+        print(f"Over budget: {', '.join(overBudget)}.")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
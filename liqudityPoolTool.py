@@ -4,75 +4,790 @@
 import os, inspect, sys
 from math import sqrt
 import random
-import pandas as pd
-from time import sleep
-import urllib.request
-from bs4 import BeautifulSoup
+import threading
+import queue
+import atexit
+import functools
+import json
+import sqlite3
+import gzip
+import hashlib
+from collections import OrderedDict
+import numpy as np
+from time import sleep, monotonic, time, perf_counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import http.client
+import urllib.request, urllib.parse, urllib.error
+from html.parser import HTMLParser
 from datetime import datetime
-import matplotlib.pyplot as plt
 
 
+# Scraping target and identity. Point BASE_URL to a local server to scrape saved pages offline.
+BASE_URL = 'https://www.coingecko.com/en'
+API_URL = 'https://api.coingecko.com/api/v3'
+USER_AGENT = 'Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko)' + \
+    ' Chrome/41.0.2228.0 Safari/537.36'
+
+# Timing and counter hooks around the stages of a refresh (fetch, parse, findCell, pool math, csv)
+class Metrics:
+    '''
+    Collects per stage: number of calls and total seconds, plus free counters (i.e. bytes fetched).
+    Disabled by default: stage() then returns a shared no-op context and count() returns
+    right away, so the hooks cost next to nothing.
+    Usage:
+                >>>METRICS.enabled = True
+                >>>with METRICS.stage('fetch'): ...
+                >>>METRICS.write('metrics.prom')
+    '''
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stages = {}      # {stage: [calls, seconds]}
+        self.counters = {}    # {name: value}
+        self._lock = threading.Lock()
+
+    def stage(self, name):
+        if not self.enabled:
+            return _NO_STAGE
+        return _Stage(self, name)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def _add(self, name, seconds):
+        with self._lock:
+            entry = self.stages.setdefault(name, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+    def reset(self):
+        with self._lock:
+            self.stages.clear()
+            self.counters.clear()
+
+    def summary(self):
+        '''
+        Returns dict {'stages': {stage: {'calls', 'seconds'}}, 'counters': {name: value}}.
+        '''
+        with self._lock:
+            return {
+                'stages': {name: {'calls': calls, 'seconds': seconds}
+                           for name, (calls, seconds) in self.stages.items()},
+                'counters': dict(self.counters)
+                }
+
+    def toPrometheus(self, prefix='lpt'):
+        '''
+        Returns metrics in Prometheus text exposition format.
+        '''
+        summary = self.summary()
+        lines = [f'# TYPE {prefix}_stage_calls_total counter']
+        lines += [f'{prefix}_stage_calls_total{{stage="{name}"}} {v["calls"]}' for name, v in summary['stages'].items()]
+        lines += [f'# TYPE {prefix}_stage_seconds_total counter']
+        lines += [f'{prefix}_stage_seconds_total{{stage="{name}"}} {v["seconds"]:.6f}'
+                  for name, v in summary['stages'].items()]
+        lines += [f'# TYPE {prefix}_events_total counter']
+        lines += [f'{prefix}_events_total{{name="{name}"}} {value}' for name, value in summary['counters'].items()]
+        return '\n'.join(lines) + '\n'
+
+    def write(self, fileName):
+        '''
+        Writes metrics to fileName: Prometheus text format for *.prom / *.txt, else json.
+        '''
+        if fileName.endswith(('.prom', '.txt')):
+            text = self.toPrometheus()
+        else:
+            text = json.dumps(self.summary(), indent=2)
+        with open(fileName, 'w') as file:
+            file.write(text)
+
+class _Stage:
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+
+    def __exit__(self, *exc):
+        self.metrics._add(self.name, perf_counter() - self.start)
+        return False
+
+class _NoStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        return False
+
+_NO_STAGE = _NoStage()
+
+# Hooks used by all stages of this module. Set METRICS.enabled = True to collect.
+METRICS = Metrics()
+
+# Decorator: Times every call of a function as stage {name} of METRICS (if enabled)
+def timedStage(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not METRICS.enabled:
+                return func(*args, **kwargs)
+            with METRICS.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# Kept-alive connections, one per thread and host (see fetchPage())
+_connections = threading.local()
+
+# Token bucket rate limiter, can be shared by many scraping threads (one bucket per host)
+class RateLimiter:
+    '''
+    Allows on average {rate} requests per second and host, with bursts of up to {burst}.
+    Call acquire(host) before every request. Blocks until the request is allowed.
+    '''
+    def __init__(self, rate=1.0, burst=1):
+        assert rate > 0 and burst >= 1, 'RateLimiter(): rate must be > 0 and burst >= 1.'
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}    # {host: (tokens left, time of last refill)}
+        self._lock = threading.Lock()
+
+    def acquire(self, host):
+        while True:
+            with self._lock:
+                now = monotonic()
+                tokens, last = self._buckets.get(host, (self.burst, now))
+                tokens = min(self.burst, tokens + (now - last) * self.rate)
+
+                # Possibility: Token available. Take it and go.
+                if tokens >= 1:
+                    self._buckets[host] = (tokens - 1, now)
+                    return
+                self._buckets[host] = (tokens, now)
+                wait = (1 - tokens) / self.rate
+
+            # Possibility: Bucket empty. Sleep (without holding the lock) until next token.
+            sleep(wait)
+
+# Helper function: Returns this thread's open connection to a host (creates it if necessary)
+def _getConnection(scheme, netloc, timeout):
+    pool = _connections.__dict__.setdefault('pool', {})
+    if (scheme, netloc) not in pool:
+        if scheme == 'https':
+            pool[(scheme, netloc)] = http.client.HTTPSConnection(netloc, timeout=timeout)
+        else:
+            pool[(scheme, netloc)] = http.client.HTTPConnection(netloc, timeout=timeout)
+    return pool[(scheme, netloc)]
+
+# Downloads a website over a kept-alive connection and returns its raw content
+def fetchPage(url, timeout=10, retries=3, rateLimiter=None, headers=None, returnResponse=False):
+    '''
+    Assumes a full url, i.e. BASE_URL + '/coins/ethereum'.
+    Returns the body of the response (bytes).
+    rateLimiter: If a RateLimiter is given, waits for it before every attempt.
+    headers: Dict of extra request headers, i.e. {'If-None-Match': etag}.
+    returnResponse: Returns tuple (status, responseHeaders, body) instead and accepts
+                    304 'Not Modified' (with empty body) as an answer to conditional requests.
+    Retries up to {retries} times (with exponential backoff) on connection errors,
+    timeouts, HTTP 429 and 5xx responses. Raises the last error if all attempts fail.
+    '''
+    requestHeaders = {'User-Agent': USER_AGENT, 'Connection': 'keep-alive'}
+    if headers:
+        requestHeaders.update(headers)
+
+    requestedUrl = url
+    attempt, redirects = 0, 0
+    while True:
+        parts = urllib.parse.urlsplit(url)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        if rateLimiter:
+            with METRICS.stage('rateLimitWait'):
+                rateLimiter.acquire(parts.netloc)
+
+        conn = _getConnection(parts.scheme, parts.netloc, timeout)
+        reused = conn.sock is not None
+        try:
+            with METRICS.stage('fetch'):
+                conn.request('GET', path, headers=requestHeaders)
+                response = conn.getresponse()
+                body = response.read()
+            METRICS.count('fetchBytes', len(body))
+            error = None
+        except (OSError, http.client.HTTPException) as e:
+            METRICS.count('fetchErrors')
+            conn.close()
+            error = e
+
+            # Possibility: Server closed an idle kept-alive connection. Reconnect right away.
+            if reused:
+                continue
+        else:
+            if response.status == 200 or (response.status == 304 and returnResponse):
+                # Option: Keep the raw page (under the url asked for, not the redirect target)
+                if PAGE_ARCHIVE is not None and response.status == 200:
+                    with METRICS.stage('archive'):
+                        PAGE_ARCHIVE.put(requestedUrl, body)
+                if returnResponse:
+                    return response.status, response.headers, body
+                return body
+
+            # Possibility: Redirect. Follow it (max. 5 times).
+            if response.status in {301, 302, 303, 307, 308} and redirects < 5:
+                url = urllib.parse.urljoin(url, response.getheader('Location'))
+                redirects += 1
+                continue
+
+            error = urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+
+            # Possibility: Client error other than 'Too Many Requests'. Retrying won't help.
+            if response.status != 429 and response.status < 500:
+                raise error
+
+        if attempt >= retries:
+            raise error
+        METRICS.count('fetchRetries')
+        sleep(0.5 * 2**attempt)
+        attempt += 1
+
+
+# Content-addressed archive of raw pages: gzip files named by their sha256, plus an SQLite index of fetches
+class PageArchive:
+    '''
+    Keeps the raw body of every page fetchPage() downloads while PAGE_ARCHIVE is set, so
+    metrics can be re-extracted later without the network (see reextractArchive()).
+    Each distinct page is stored once as {root}/objects/{hash[:2]}/{hash}.gz.
+    Each fetch is a row in {root}/index.db: time (epoch seconds), url, kind, key, hash.
+    kind, key: 'token', tokenStr for token pages; 'listing', page number for listing pages;
+               'other', url for everything else (i.e. API responses).
+    '''
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+        self._lock = threading.Lock()    # fetchPage() may be called from several threads
+        self.conn = sqlite3.connect(os.path.join(root, 'index.db'), check_same_thread=False)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS fetches (id INTEGER PRIMARY KEY, time REAL NOT NULL, '
+            'url TEXT, kind TEXT, key TEXT, hash TEXT NOT NULL)'
+            )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS fetches_kind_time ON fetches (kind, time)')
+        self.conn.commit()
+
+    def put(self, url, body, fetchedAt=None):
+        '''
+        Stores body (bytes) fetched from url at fetchedAt (epoch seconds, default: now).
+        Returns the sha256 hex digest the page is stored under.
+        '''
+        digest = hashlib.sha256(body).hexdigest()
+        path = _archivePath(self.root, digest)
+
+        # Possibility: Page is new. Write it to a temporary file first, so readers never see half a page.
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmpPath = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with gzip.open(tmpPath, 'wb', compresslevel=6) as file:
+                file.write(body)
+            os.replace(tmpPath, path)
+
+        kind, key = _pageKind(url)
+        with self._lock, self.conn:
+            self.conn.execute('INSERT INTO fetches (time, url, kind, key, hash) VALUES (?, ?, ?, ?, ?)',
+                              (time() if fetchedAt is None else fetchedAt, url, kind, key, digest))
+        return digest
+
+    def get(self, digest):
+        '''
+        Returns the page (bytes) stored under digest.
+        '''
+        return _readArchived(self.root, digest)
+
+    def entries(self, kind=None, start=None, end=None):
+        '''
+        Returns list of fetches (time, url, kind, key, hash), sorted by time.
+        kind:       Only fetches of this kind ('token', 'listing' or 'other').
+        start, end: Only fetches with start <= time < end (datetime or epoch seconds).
+        '''
+        where, params = [], []
+        if kind is not None:
+            where.append('kind = ?')
+            params.append(kind)
+        if start is not None:
+            where.append('time >= ?')
+            params.append(_toEpoch(start))
+        if end is not None:
+            where.append('time < ?')
+            params.append(_toEpoch(end))
+
+        sql = 'SELECT time, url, kind, key, hash FROM fetches'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY time, id'
+        with self._lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def stats(self):
+        '''
+        Returns dict with number of fetches, distinct pages, and bytes on disk (compressed).
+        '''
+        with self._lock:
+            fetches = self.conn.execute('SELECT COUNT(*) FROM fetches').fetchone()[0]
+            digests = [row[0] for row in self.conn.execute('SELECT DISTINCT hash FROM fetches')]
+        sizes = [os.path.getsize(_archivePath(self.root, digest)) for digest in digests]
+        return {'fetches': fetches, 'pages': len(digests), 'bytes': sum(sizes)}
+
+    def close(self):
+        self.conn.close()
+
+# Archive that fetchPage() stores pages in (None: don't archive)
+PAGE_ARCHIVE = None
+
+# Helper function: Returns path of the file a page with this sha256 digest is stored in
+def _archivePath(root, digest):
+    return os.path.join(root, 'objects', digest[:2], digest + '.gz')
+
+# Helper function: Returns page stored in an archive (module-level, so worker processes can call it)
+def _readArchived(root, digest):
+    with gzip.open(_archivePath(root, digest), 'rb') as file:
+        return file.read()
+
+# Helper function: Returns (kind, key) of a url, i.e. ('token', 'ethereum') or ('listing', '2')
+def _pageKind(url):
+    parts = urllib.parse.urlsplit(url)
+    basePath = urllib.parse.urlsplit(BASE_URL).path.rstrip('/')
+    if parts.path.startswith(basePath + '/coins/'):
+        return 'token', parts.path[len(basePath + '/coins/'):].strip('/')
+    if parts.path.rstrip('/') == basePath:
+        return 'listing', urllib.parse.parse_qs(parts.query).get('page', ['1'])[0]
+    return 'other', url
+
+
+
+# Fetch-and-parse cache for token pages: in-memory LRU, optionally backed by one json file per token
+class TokenCache:
+    '''
+    Caches parsed token metrics (as returned by getTokenMetrics()) per token.
+    ttl:      Seconds an entry is served without touching the network.
+    maxSize:  Max. number of tokens kept in memory. Least recently used tokens are dropped first.
+    cacheDir: If set, entries are also written to this dir and survive restarts.
+    Stale entries keep their ETag / Last-Modified header, so they can be revalidated
+    with a conditional request instead of downloading and parsing the page again.
+    Counters: hits (fresh entry served), misses (network needed), revalidated (304 received).
+    '''
+    def __init__(self, ttl=60, maxSize=512, cacheDir=None):
+        self.ttl = ttl
+        self.maxSize = maxSize
+        self.cacheDir = cacheDir
+        self.hits, self.misses, self.revalidated = 0, 0, 0
+        self._entries = OrderedDict()    # {token: {'time', 'etag', 'lastModified', 'value'}}
+        self._lock = threading.Lock()
+        if cacheDir:
+            os.makedirs(cacheDir, exist_ok=True)
+
+    # Helper function: Returns entry from memory or disk (None if not cached at all)
+    def _entry(self, key):
+        entry = self._entries.get(key)
+        if entry is None and self.cacheDir:
+            try:
+                with open(self._path(key), 'r') as file:
+                    entry = json.load(file)
+            except (OSError, ValueError):
+                return None
+            self._remember(key, entry)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxSize:
+            self._entries.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.cacheDir, urllib.parse.quote(key, safe='') + '.json')
+
+    def _save(self, key, entry):
+        if self.cacheDir:
+            with open(self._path(key), 'w') as file:
+                json.dump(entry, file)
+
+    def getFresh(self, key):
+        '''
+        Returns a copy of the cached value if younger than ttl, else None.
+        '''
+        with self._lock:
+            entry = self._entry(key)
+            if entry is not None and time() - entry['time'] < self.ttl:
+                self.hits += 1
+                return dict(entry['value'])
+            self.misses += 1
+            return None
+
+    def validators(self, key):
+        '''
+        Returns headers for a conditional request for a stale entry ({} if there is nothing to revalidate).
+        '''
+        with self._lock:
+            entry = self._entry(key)
+            headers = {}
+            if entry is not None:
+                if entry['etag']:
+                    headers['If-None-Match'] = entry['etag']
+                if entry['lastModified']:
+                    headers['If-Modified-Since'] = entry['lastModified']
+            return headers
+
+    def revalidate(self, key):
+        '''
+        Call after a 304 response: Marks the stale entry as fresh again and returns a copy of its value.
+        Returns None if the entry was dropped in the meantime (i.e. evicted by other tokens).
+        '''
+        with self._lock:
+            entry = self._entry(key)
+            if entry is None:
+                return None
+            entry['time'] = time()
+            self.revalidated += 1
+            self._save(key, entry)
+            return dict(entry['value'])
+
+    def put(self, key, value, responseHeaders=None):
+        '''
+        Stores value for key, together with ETag / Last-Modified of responseHeaders (if given).
+        '''
+        responseHeaders = responseHeaders or {}
+        entry = {
+            'time': time(),
+            'etag': responseHeaders.get('ETag'),
+            'lastModified': responseHeaders.get('Last-Modified'),
+            'value': dict(value)
+            }
+        with self._lock:
+            self._remember(key, entry)
+            self._save(key, entry)
+
+    def stats(self):
+        '''
+        Returns dict of cache counters and current number of tokens in memory.
+        '''
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'revalidated': self.revalidated, 'size': len(self._entries)}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits, self.misses, self.revalidated = 0, 0, 0
+
+# Cache shared by getTokenPrice(), getTokenMc() and getTokenMetrics(). Set to None to disable.
+TOKEN_CACHE = TokenCache(ttl=60)
+
 # Scrapes and returns price of 1 asset from coingecko
-def getTokenPrice(tokenStr):
+def getTokenPrice(tokenStr, cache=None):
     '''
     Assumes a string matching an existing html child of 'coingecko.com/en/coins/', i.e. 'ethereum'.
     Returns float of current asset price (USD) as given on coingecko.com.
+    cache: See getTokenMetrics().
     '''
-    url = 'https://www.coingecko.com/en/coins/' + tokenStr
-    userAgent = 'Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko)' + \
-        ' Chrome/41.0.2228.0 Safari/537.36'
-    req = urllib.request.Request(url, headers= {'User-Agent' : userAgent})
-    html = urllib.request.urlopen(req)
-    bs = BeautifulSoup(html.read(), 'html.parser')
-    
-    # Scrape price data
-    varList = bs.findAll('span', {'class': 'no-wrap'})  
-    priceStr = varList[0].get_text()
-    priceUSD = float(priceStr.replace(',','').replace('$',''))
-    
-    # Sleep max 2 seconds before function can be called again
-    sleep(random.random()*2)
-    
-    return priceUSD
+    return getTokenMetrics(tokenStr, waitAfter=2, cache=cache)['priceUSD']
 
 # Scrapes and returns market cap of 1 asset from coingecko
-def getTokenMc(tokenStr):
+def getTokenMc(tokenStr, cache=None):
     '''
     Assumes a string matching an existing html child of 'coingecko.com/en/coins/', i.e. 'ethereum'.
-    Returns float of current asset price (USD) as given on coingecko.com.
+    Returns float of current market cap (USD) as given on coingecko.com.
+    cache: See getTokenMetrics().
     '''
-    url = 'https://www.coingecko.com/en/coins/' + tokenStr
-    userAgent = 'Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko)' + \
-        ' Chrome/41.0.2228.0 Safari/537.36'
-    req = urllib.request.Request(url, headers= {'User-Agent' : userAgent})
-    html = urllib.request.urlopen(req)
-    bs = BeautifulSoup(html.read(), 'html.parser')
-    
-    # Scrape price data
-    varList = bs.findAll('span', {'class': 'no-wrap'})  
-    priceStr = varList[0].get_text()
-    priceUSD = float(priceStr.replace(',','').replace('$',''))
-    
-    # Sleep max 2 seconds before function can be called again
-    sleep(random.random()*2)
-    
-    return priceUSD
+    return getTokenMetrics(tokenStr, waitAfter=2, cache=cache)['mcUSD']
 
 
 
-def plot_line(df, col_x, col_y):
+# Interface of price providers: Return current USD prices for many tokens at once
+class PriceProvider:
+    '''
+    Subclasses implement getPrices(tokens), which assumes a list of coingecko ids
+    (i.e. ['ethereum', 'dai']) and returns dict {token: priceUSD}.
+    Tokens that can't be priced are left out of the dict.
+    '''
+    def getPrices(self, tokens):
+        raise NotImplementedError
+
+# Prices every token from its own coingecko page (one request per token unless cached)
+class PagePriceProvider(PriceProvider):
+    def __init__(self, cache=None):
+        self.cache = cache
+
+    def getPrices(self, tokens):
+        prices = {}
+        for tokenStr in dict.fromkeys(tokens):
+            try:
+                prices[tokenStr] = getTokenPrice(tokenStr, cache=self.cache)
+            except (OSError, http.client.HTTPException, IndexError, ValueError) as e:
+                print(f"PagePriceProvider.getPrices(): Couldn't price '{tokenStr}': {e!r}")
+        return prices
+
+# Prices up to {chunkSize} tokens per request from coingecko's json api, the rest from their pages
+class BulkPriceProvider(PriceProvider):
+    '''
+    Uses {apiUrl}/simple/price, which returns prices for many ids at once.
+    Tokens the api doesn't know (or all of them, if the api fails) are handed to
+    fallback (default: PagePriceProvider).
+    '''
+    def __init__(self, apiUrl=None, chunkSize=250, fallback=None, timeout=10, retries=3):
+        self.apiUrl = apiUrl
+        self.chunkSize = chunkSize
+        self.fallback = fallback if fallback is not None else PagePriceProvider()
+        self.timeout = timeout
+        self.retries = retries
+
+    def getPrices(self, tokens):
+        tokens = list(dict.fromkeys(tokens))
+        prices = {}
+        for i in range(0, len(tokens), self.chunkSize):
+            chunk = tokens[i:i + self.chunkSize]
+            query = urllib.parse.urlencode({'ids': ','.join(chunk), 'vs_currencies': 'usd'})
+            try:
+                answer = json.loads(fetchPage(
+                    f'{self.apiUrl or API_URL}/simple/price?{query}', timeout=self.timeout, retries=self.retries
+                    ))
+            except (OSError, http.client.HTTPException, ValueError) as e:
+                print(f"BulkPriceProvider.getPrices(): Api request failed ({e!r}), using fallback.")
+                continue
+            for tokenStr in chunk:
+                if 'usd' in answer.get(tokenStr, {}):
+                    prices[tokenStr] = float(answer[tokenStr]['usd'])
+
+        # Possibility: Some tokens weren't priced by the api. Ask fallback.
+        missing = [tokenStr for tokenStr in tokens if tokenStr not in prices]
+        if missing and self.fallback:
+            prices.update(self.fallback.getPrices(missing))
+        return prices
+
+# Local stand-in: Returns prices from a dict (for tests and offline runs)
+class StaticPriceProvider(PriceProvider):
+    '''
+    Assumes dict {token: priceUSD}. Counts calls of getPrices() in self.calls.
+    '''
+    def __init__(self, prices):
+        self.prices = dict(prices)
+        self.calls = 0
+
+    def getPrices(self, tokens):
+        self.calls += 1
+        return {tokenStr: self.prices[tokenStr] for tokenStr in tokens if tokenStr in self.prices}
+
+# Fills in current prices of both tokens of every pair (one getPrices() call for the whole portfolio)
+def addPrices(dataDict, provider=None):
+    '''
+    Assumes nested dict of asset pairings containing 'colStr' and 'assStr' respectively.
+    Returns a copy in which every pair has 'priceCol' and 'priceAss' (USD), ready for getPoolStatus().
+    Pairs with a token the provider couldn't price are left out (with a warning).
+    provider: PriceProvider to use. Defaults to BulkPriceProvider().
+    If dataDict is a PoolTable, sets its price columns instead and returns it
+    (or a new PoolTable without the unpriced pairs).
+    '''
+    # Get name of function for error messages (depends on inspect, sys)
+    funcName = inspect.currentframe().f_code.co_name
+    provider = provider or BulkPriceProvider()
+
+    if isinstance(dataDict, PoolTable):
+        tokens = dataDict.tokens
+    else:
+        tokens = [d[key] for d in dataDict.values() for key in ('colStr', 'assStr')]
+    prices = provider.getPrices(tokens)
+    missing = sorted(set(tokens) - set(prices))
+
+    # Possibility: Some tokens couldn't be priced. Leave out the pairs containing them.
+    if missing:
+        if isinstance(dataDict, PoolTable):
+            priced = np.array([tokenStr in prices for tokenStr in dataDict.tokens])
+            keep = priced[dataDict['colId']] & priced[dataDict['assId']]
+            dropped = [pair for pair, kept in zip(dataDict.keys, keep.tolist()) if not kept]
+            dataDict = dataDict.take(keep)
+        else:
+            dropped = [pair for pair, d in dataDict.items() if d['colStr'] in missing or d['assStr'] in missing]
+            dataDict = {pair: d for pair, d in dataDict.items() if pair not in dropped}
+        print(f"{funcName}(): Couldn't get prices for {missing}. Leaving out {dropped}.")
+
+    if isinstance(dataDict, PoolTable):
+        return dataDict.setPrices(prices)
+
+    pricedDict = {}
+    for pair, d in dataDict.items():
+        pricedDict[pair] = dict(d, priceCol=prices[d['colStr']], priceAss=prices[d['assStr']])
+    return pricedDict
+
+def plot_line(df, col_x, col_y, fileName=None, maxPoints=None, method='lttb'):
     '''
     Quick labeled line plot of one dfCol vs. another.
     Assumes col_x and col_y column labels (str) of df.
+    A 'time' column as written by updateCSV() ("2021 Feb 18 17:34") is parsed to datetimes.
+    fileName:  If set, renders to this file (.png, .svg, .pdf) without a display instead of showing the plot.
+    maxPoints: If set, downsamples to about {maxPoints} points with {method} (see downsampleIndices()).
     '''
     assert type(col_x) == str and type(col_y) == str, 'col_x and col_y must be strings, ya dummy...'
+
+    # Possibility: x is the 'time' column of a csv (str like "2021 Feb 18 17:34"). Parse it, so
+    # points are sorted chronologically (not alphabetically) and can be downsampled.
+    import pandas as pd
+    if col_x == 'time' and not pd.api.types.is_datetime64_any_dtype(df[col_x]):
+        df = df.assign(time=pd.to_datetime(df[col_x], format='%Y %b %d %H:%M'))
     plotDf = df.sort_values(by=col_x, inplace=False)
-    plt.plot(plotDf[col_x].values, plotDf[col_y].values)
+    x, y = plotDf[col_x].values, plotDf[col_y].values
+    if maxPoints:
+        idx = downsampleIndices(x, y, maxPoints, method=method)
+        x, y = x[idx], y[idx]
+    title = 'Line Plot of %s and %s' % (col_y, col_x)
+
+    # Possibility: fileName given. Render headless (no pyplot, no GUI backend).
+    if fileName:
+        renderLine(x, y, fileName, xlabel=col_x, ylabel=col_y, title=title)
+        return
+
+    import matplotlib.pyplot as plt
+    plt.plot(x, y)
     plt.xlabel(col_x)
     plt.ylabel(col_y)
-    plt.title('Line Plot of %s and %s' % (col_y, col_x))
+    plt.title(title)
     plt.show()
 
+# Helper function: Returns x as numbers (datetimes as int64) for downsampling math
+def _asNumbers(x):
+    x = np.asarray(x)
+    if np.issubdtype(x.dtype, np.datetime64):
+        return x.astype('datetime64[ns]').astype(np.int64).astype(float)
+    return x.astype(float)
+
+# Returns indices of points to keep so a line plot of (x, y) looks the same with fewer points
+def downsampleIndices(x, y, nOut, method='lttb'):
+    '''
+    Assumes arrays x (sorted, numbers or datetimes) and y of the same length.
+    Returns sorted array of at most about {nOut} indices, always including first and last point.
+    method: 'lttb':   Largest-Triangle-Three-Buckets, keeps the visually most important point per bucket.
+            'minmax': Keeps min and max of every bucket (nOut / 2 buckets), fully vectorized.
+    '''
+    # Get name of function for error messages (depends on inspect, sys)
+    funcName = inspect.currentframe().f_code.co_name
+    assert method in {'lttb', 'minmax'}, f"{funcName}(): method must be 'lttb' or 'minmax'."
+    n = len(y)
+    if nOut >= n or n < 3 or nOut < 3:
+        return np.arange(n)
+    y = np.asarray(y, dtype=float)
+
+    # Possibility: minmax. Min and max of equally sized buckets (last bucket may be shorter).
+    if method == 'minmax':
+        size = -(-n // max(1, nOut // 2))
+        starts = np.arange(0, n, size)
+        padded = np.full(len(starts) * size, np.nan)
+        padded[:n] = y
+        buckets = padded.reshape(-1, size)
+        idx = np.concatenate([[0, n - 1], starts + np.nanargmin(buckets, axis=1),
+                              starts + np.nanargmax(buckets, axis=1)])
+        return np.unique(idx)
+
+    # Possibility: lttb. Per bucket, pick the point spanning the largest triangle with the point
+    # picked before and the average of the next bucket.
+    x = _asNumbers(x)
+    edges = np.linspace(1, n - 1, nOut - 1).astype(np.intp)
+    idx = np.empty(nOut, dtype=np.intp)
+    idx[0], idx[-1] = 0, n - 1
+    a = 0
+    for i in range(nOut - 2):
+        lo, hi = edges[i], edges[i + 1]
+        nextHi = edges[i + 2] if i + 2 < len(edges) else n
+        avgX, avgY = x[hi:nextHi].mean(), y[hi:nextHi].mean()
+        area = np.abs((x[a] - avgX) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avgY - y[a]))
+        a = lo + int(np.argmax(area))
+        idx[i + 1] = a
+    return np.unique(idx)
+
+# Renders a line plot to an image file with matplotlib's non-interactive Agg canvas (works headless)
+def renderLine(x, y, fileName, xlabel='', ylabel='', title='', size=(10, 4), dpi=100):
+    '''
+    Assumes arrays x and y. Format follows the extension of fileName (.png, .svg, .pdf).
+    '''
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=size, dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    ax.plot(x, y, linewidth=1)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    ax.set_title(title)
+    fig.autofmt_xdate()
+    fig.savefig(fileName)
+
+# Renders the history of one pool from a HistoryStore or csv, downsampled, to an image file
+def plotHistory(source, token, col_y, fileName, start=None, end=None, maxPoints=2000, method='lttb'):
+    '''
+    source:     HistoryStore (reads only token, col_y and the time window via its index) or
+                csv written by updateCSV() (reads only columns time, token, col_y, in chunks).
+    start, end: Time window (datetime or epoch seconds), end excluded.
+    Downsamples to about {maxPoints} points (see downsampleIndices()) and renders to fileName.
+    Returns number of points in the time window.
+    '''
+    times, values = _historySeries(source, token, col_y, start, end)
+    nPoints = len(values)
+    idx = downsampleIndices(times, values, maxPoints, method=method)
+    renderLine(times[idx], values[idx], fileName, xlabel='time', ylabel=col_y, title=f'{token}: {col_y}')
+    return nPoints
+
+# Helper function: Returns (times as datetime64, values) of one token / column from a HistoryStore or csv
+def _historySeries(source, token, col_y, start=None, end=None):
+    if isinstance(source, HistoryStore):
+        df = source.query(token=token, start=start, end=end, columns=[col_y])
+        return df['time'].values.astype('datetime64[s]'), df[col_y].values.astype(float)
+
+    import pandas as pd
+    start = None if start is None else pd.Timestamp(datetime.fromtimestamp(_toEpoch(start)))
+    end = None if end is None else pd.Timestamp(datetime.fromtimestamp(_toEpoch(end)))
+
+    # Keep only rows of token within [start, end) of every chunk, so memory depends on the result only
+    timeParts, valueParts = [np.array([], dtype='datetime64[ns]')], [np.array([], dtype=float)]
+    for chunk in pd.read_csv(source, usecols=['time', 'token', col_y], chunksize=200000):
+        chunk = chunk[chunk['token'] == token]
+        times = pd.to_datetime(chunk['time'], format='%Y %b %d %H:%M')
+        mask = np.ones(len(chunk), dtype=bool)
+        if start is not None:
+            mask &= (times >= start).values
+        if end is not None:
+            mask &= (times < end).values
+        timeParts.append(times.values[mask])
+        valueParts.append(chunk[col_y].values[mask].astype(float))
+    return np.concatenate(timeParts), np.concatenate(valueParts)
+
+# Renders one chart per pool (i.e. on a schedule), see plotHistory()
+def renderAllPools(source, col_y, outDir, fmt='png', **kwargs):
+    '''
+    Assumes HistoryStore or csv (see plotHistory()). Writes {outDir}/{pool}_{col_y}.{fmt} for
+    every pool (token column) in source. kwargs are passed to plotHistory().
+    Returns list of files written.
+    '''
+    if isinstance(source, HistoryStore):
+        pools = [row[0] for row in source.conn.execute(f'SELECT DISTINCT token FROM {_quote(source.table)}')]
+    else:
+        import pandas as pd
+        pools = list(dict.fromkeys(
+            token for chunk in pd.read_csv(source, usecols=['token'], chunksize=500000)
+            for token in chunk['token'].unique()
+            ))
+
+    os.makedirs(outDir, exist_ok=True)
+    files = []
+    for pool in pools:
+        fileName = os.path.join(outDir, '%s_%s.%s' % (urllib.parse.quote(str(pool), safe=''), col_y, fmt))
+        plotHistory(source, pool, col_y, fileName, **kwargs)
+        files.append(fileName)
+    return files
+
 # Returns 1 tuple of current pool allocation given initial asset amounts and current prices
 def balanceAssets(asset1Amount, asset1Price, asset2Amount, asset2Price, roundTo=None):
     '''
@@ -101,48 +816,785 @@ def getPoolVal(asset1Amount, asset1Price, asset2Amount, asset2Price, roundTo=Non
     else:
         return poolVal
 
-def getPoolStatus(data, roundTo=2):
+# Returns arrays of current pool allocations and values for many positions in one vectorized pass
+@timedStage('balancePools')
+def balancePools(numColEntry, priceCol, numAssEntry, priceAss):
+    '''
+    Vectorized version of balanceAssets() followed by getPoolVal() (results agree within 1 ulp).
+    Assumes array-likes (or scalars) of token amounts at pool entry and current usd prices.
+    Returns tuple of float arrays (amtCol, amtAss, poolValue), one value per position.
+
+    All inputs are broadcast against each other, so price scenarios can be evaluated
+    without loops, i.e. entry amounts of shape (nPositions,) and prices of shape
+    (nShocks, nPositions) return arrays of shape (nShocks, nPositions).
+    '''
+    numColEntry = np.asarray(numColEntry, dtype=float)
+    numAssEntry = np.asarray(numAssEntry, dtype=float)
+    priceCol = np.asarray(priceCol, dtype=float)
+    priceAss = np.asarray(priceAss, dtype=float)
+
+    # Same operations (and order of operations) as balanceAssets(). Only the square differs:
+    # numpy multiplies (correctly rounded), Python's float ** calls libm pow(), which can be
+    # 1 ulp off. So about 1 in 1000 results differ from the scalar functions in the last bit.
+    meanVal = np.sqrt(numColEntry * priceCol + numAssEntry * priceAss)**2
+    amtCol = 0.5 * meanVal / priceCol
+    amtAss = 0.5 * meanVal / priceAss
+    poolVal = (amtCol * priceCol) + (amtAss * priceAss)
+
+    return amtCol, amtAss, poolVal
+
+# Returns price array of shape (nShocks, nPositions) by applying relative shocks to current prices
+def shockPrices(prices, shocks):
+    '''
+    Assumes array-like of current prices (one per position) and array-like of
+    relative price changes, i.e. [-0.5, 0, 0.5] for -50%, unchanged, +50%.
+    Returns 2d array of shocked prices with one row per shock.
+    '''
+    prices = np.asarray(prices, dtype=float)
+    shocks = np.asarray(shocks, dtype=float)
+    return prices[np.newaxis, :] * (1 + shocks)[:, np.newaxis]
+
+# Converts nested dict of token pairs to column arrays for balancePools()
+def poolDataToArrays(data):
+    '''
+    Assumes nested dict of token pairs as used by getPoolStatus() (or a PoolTable).
+    Returns tuple (pairs, columns): list of pair names and dict of float arrays
+    with keys 'numColEntry', 'priceCol', 'numAssEntry', 'priceAss'.
+    '''
+    # Possibility: Table. Columns are already arrays.
+    if isinstance(data, RecordTable):
+        return data.keys, {key: data[key] for key in ['numColEntry', 'priceCol', 'numAssEntry', 'priceAss']}
+
+    pairs = list(data)
+    columns = {}
+    for key in ['numColEntry', 'priceCol', 'numAssEntry', 'priceAss']:
+        columns[key] = np.fromiter((data[pair][key] for pair in pairs), dtype=float, count=len(pairs))
+
+    return pairs, columns
+
+# Helper function: Rounds every value of an array with built-in round(). np.round() scales by 10**roundTo,
+# which can round differently (26962993098.79 vs. 26962993098.8).
+def _roundArray(arr, roundTo):
+    return np.array([round(v, roundTo) for v in arr.tolist()], dtype=float)
+
+@timedStage('getPoolStatus')
+def getPoolStatus(data, roundTo=2, fees=None):
     '''
     Assumes nested dict of token pairs. Returns nested dict:
     Returns per pair: current value of pool, current amount of collateral,
     current amount of asset.
+    fees: If a FeeAccumulator is given, adds estimated fees earned so far ('fees', USD)
+          and 'poolValueInclFees' per pair.
+    If data is a PoolTable, returns a RecordTable with the same columns instead
+    (rounded like the dicts, no dicts are built).
     '''
+    pairs, c = poolDataToArrays(data)
+    amtCol, amtAss, poolVal = balancePools(
+        c['numColEntry'], c['priceCol'], c['numAssEntry'], c['priceAss']
+        )
+
+    # Possibility: Table given. Return table.
+    if isinstance(data, RecordTable):
+        columns = {'poolValue': poolVal, 'amtCol': amtCol, 'amtAss': amtAss}
+        if fees:
+            feeArr = fees.feesFor(pairs)
+            columns['fees'] = feeArr
+            columns['poolValueInclFees'] = poolVal + feeArr
+        return RecordTable(pairs, {key: _roundArray(col, roundTo) for key, col in columns.items()})
+
+    # Round with built-in round() to keep results identical to the scalar functions
     poolData = {}
-    for pair in data:
-        d = data[pair]
-        amtColNow, amtAssNow = balanceAssets(
-            d['numColEntry'],
-            d['priceCol'],
-            d['numAssEntry'],
-            d['priceAss']
-            )
-        poolVal = getPoolVal(
-            amtColNow, d['priceCol'], amtAssNow, d['priceAss']
-            )
+    for pair, val, col, ass in zip(pairs, poolVal.tolist(), amtCol.tolist(), amtAss.tolist()):
         poolData[pair] = {
-            'poolValue': round(poolVal, roundTo),
-            'amtCol': round(amtColNow, roundTo),
-            'amtAss': round(amtAssNow, roundTo)
+            'poolValue': round(val, roundTo),
+            'amtCol': round(col, roundTo),
+            'amtAss': round(ass, roundTo)
             }
-        
+
+    # Option: Add accrued fees
+    if fees:
+        for pair, val, fee in zip(pairs, poolVal.tolist(), fees.feesFor(pairs).tolist()):
+            poolData[pair]['fees'] = round(fee, roundTo)
+            poolData[pair]['poolValueInclFees'] = round(val + fee, roundTo)
+
     return poolData
 
 
+# Generator: Yields price history of a token pair chunk by chunk as (times, pricesCol, pricesAss) arrays
+def iterPriceChunks(source, colStr, assStr, chunksize=100000, timeCol='time', tokenCol='token',
+                    priceCol='priceUSD'):
+    '''
+    source: DataFrame or path of a csv / parquet file (parquet needs pyarrow), sorted by time,
+            in one of two formats (detected from the columns):
+            wide: columns {timeCol}, {colStr}, {assStr} (prices)
+            long: columns {timeCol}, {tokenCol}, {priceCol}, one row per token and time,
+                  i.e. a csv written by updateCSV(createMetricsDict(...), fileName).
+    Only needed columns are read, {chunksize} rows at a time. Times where one of the prices is
+    missing are skipped.
+    '''
+    import pandas as pd
+    # Get name of function for error messages (depends on inspect, sys)
+    funcName = inspect.currentframe().f_code.co_name
+
+    # Read source in chunks (columns of the file decide the format)
+    if isinstance(source, pd.DataFrame):
+        columns = list(source.columns)
+    elif str(source).endswith('.parquet'):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError(f'{funcName}(): Reading parquet files needs pyarrow (pip install pyarrow).')
+        parquetFile = pq.ParquetFile(source)
+        columns = parquetFile.schema_arrow.names
+    else:
+        columns = list(pd.read_csv(source, nrows=0).columns)
+
+    isLong = colStr not in columns
+    usecols = [timeCol, tokenCol, priceCol] if isLong else [timeCol, colStr, assStr]
+    assert set(usecols) <= set(columns), f'{funcName}(): {source} needs the columns {usecols}.'
+
+    if isinstance(source, pd.DataFrame):
+        chunks = (source[usecols].iloc[i:i + chunksize] for i in range(0, len(source), chunksize))
+    elif str(source).endswith('.parquet'):
+        chunks = (batch.to_pandas() for batch in parquetFile.iter_batches(batch_size=chunksize, columns=usecols))
+    else:
+        chunks = pd.read_csv(source, usecols=usecols, chunksize=chunksize)
+
+    # Possibility: Wide format. Prices are already side by side.
+    if not isLong:
+        for chunk in chunks:
+            chunk = chunk.dropna()
+            yield chunk[timeCol].values, chunk[colStr].values.astype(float), chunk[assStr].values.astype(float)
+        return
+
+    # Possibility: Long format. Pivot both tokens side by side per time. Rows of the last time in
+    # a chunk may continue in the next chunk, so they are held back until then.
+    carry = None
+    for chunk in chunks:
+        chunk = chunk[chunk[tokenCol].isin([colStr, assStr])]
+        if carry is not None:
+            chunk = pd.concat([carry, chunk])
+        if chunk.empty:
+            continue
+        lastTime = chunk[timeCol].iloc[-1]
+        carry = chunk[chunk[timeCol] == lastTime]
+        chunk = chunk[chunk[timeCol] != lastTime]
+        yield _pivotPrices(chunk, colStr, assStr, timeCol, tokenCol, priceCol)
+
+    if carry is not None:
+        yield _pivotPrices(carry, colStr, assStr, timeCol, tokenCol, priceCol)
+
+# Helper function: Returns (times, pricesCol, pricesAss) of a long-format chunk
+def _pivotPrices(chunk, colStr, assStr, timeCol, tokenCol, priceCol):
+    wide = chunk.pivot_table(index=timeCol, columns=tokenCol, values=priceCol, aggfunc='last', sort=False)
+    wide = wide.reindex(columns=[colStr, assStr]).dropna()
+    return wide.index.values, wide[colStr].values.astype(float), wide[assStr].values.astype(float)
+
+# Generator: Yields value and impermanent loss of many positions for every time of a price history
+def backtestIL(priceChunks, numColEntry, numAssEntry):
+    '''
+    Assumes iterable of (times, pricesCol, pricesAss) chunks (see iterPriceChunks()) and
+    array-likes of token amounts at pool entry (one per position, all in the same pair).
+    Yields dict per chunk with 'time' (T,) and arrays of shape (T, nPositions):
+    'poolValue': value of the position in a constant-product pool (k = numCol * numAss stays
+                 constant, so poolValue = 2 * sqrt(k * priceCol * priceAss)),
+    'hodlValue': value of just holding the entry amounts,
+    'il':        impermanent loss (poolValue / hodlValue - 1, <= 0).
+    Fees aren't factored in. Memory per chunk is T x nPositions, independent of history length.
+    '''
+    numColEntry = np.asarray(numColEntry, dtype=float)
+    numAssEntry = np.asarray(numAssEntry, dtype=float)
+    twoSqrtK = 2 * np.sqrt(numColEntry * numAssEntry)
+
+    for times, pricesCol, pricesAss in priceChunks:
+        # Shared by all positions: sqrt of price product (once per time, not per position)
+        sqrtPP = np.sqrt(pricesCol * pricesAss)
+        poolValue = np.multiply.outer(sqrtPP, twoSqrtK)
+        hodlValue = np.multiply.outer(pricesCol, numColEntry) + np.multiply.outer(pricesAss, numAssEntry)
+        yield {'time': times, 'poolValue': poolValue, 'hodlValue': hodlValue,
+               'il': poolValue / hodlValue - 1}
+
+# Runs backtestIL() over a whole price history and returns summary per position (bounded memory)
+def backtestSummary(priceChunks, numColEntry, numAssEntry):
+    '''
+    Same arguments as backtestIL(). Returns DataFrame with one row per position:
+    final poolValue / hodlValue / il, worst (most negative) il and its time, mean il.
+    '''
+    import pandas as pd
+    n = len(np.atleast_1d(numColEntry))
+    worstIl = np.zeros(n)
+    worstTime = np.empty(n, dtype=object)
+    sumIl = np.zeros(n)
+    count = 0
+    last = None
+
+    for result in backtestIL(priceChunks, numColEntry, numAssEntry):
+        if not len(result['time']):
+            continue
+        il = result['il']
+        rows = il.argmin(axis=0)
+        chunkWorst = il[rows, np.arange(n)]
+        better = chunkWorst < worstIl
+        worstIl[better] = chunkWorst[better]
+        worstTime[better] = result['time'][rows[better]]
+        sumIl += il.sum(axis=0)
+        count += len(il)
+        last = result
+
+    assert last is not None, "backtestSummary(): The price history is empty."
+    return pd.DataFrame({
+        'finalTime': last['time'][-1],
+        'poolValue': last['poolValue'][-1],
+        'hodlValue': last['hodlValue'][-1],
+        'il': last['il'][-1],
+        'worstIl': worstIl,
+        'worstTime': worstTime,
+        'meanIl': sumIl / count
+        })
+
+# Value range of simulatePool() histograms: il in [-1, 0], log(poolValue / entry value) in LOG_VALUE_RANGE
+LOG_VALUE_RANGE = (-10.0, 10.0)
+
+# Helper function (runs in worker processes): Simulates one block of paths, returns histograms and sums
+def _simulateBlock(args):
+    seedSeq, n, amounts, logP0, drift, vol, chol, steps, dt, bins = args
+    rng = np.random.default_rng(seedSeq)
+    twoSqrtK = 2 * np.sqrt(amounts[0] * amounts[1])
+    entryValue = amounts @ np.exp(logP0)
+
+    logP = np.repeat(logP0[np.newaxis, :], n, axis=0)
+    worstIl = np.zeros(n)
+
+    # Advance both (correlated) prices step by step. Memory: n x 2, independent of steps.
+    for _ in range(steps):
+        logP += drift * dt + vol * np.sqrt(dt) * (rng.standard_normal((n, 2)) @ chol.T)
+        poolValue = twoSqrtK * np.exp(logP.sum(axis=1) / 2)
+        il = poolValue / (np.exp(logP) @ amounts) - 1
+        np.minimum(worstIl, il, out=worstIl)
+
+    logValue = np.clip(np.log(poolValue / entryValue), *LOG_VALUE_RANGE)
+    return {
+        'ilHist': np.histogram(np.clip(il, -1, 0), bins=bins, range=(-1, 0))[0],
+        'worstIlHist': np.histogram(np.clip(worstIl, -1, 0), bins=bins, range=(-1, 0))[0],
+        'valueHist': np.histogram(logValue, bins=bins, range=LOG_VALUE_RANGE)[0],
+        'sumIl': il.sum(),
+        'sumValue': poolValue.sum()
+        }
+
+# Helper function: Returns quantiles from histogram counts (linear interpolation within bins)
+def _histQuantiles(counts, lo, hi, quantiles):
+    edges = np.linspace(lo, hi, len(counts) + 1)
+    cum = np.concatenate([[0], np.cumsum(counts)]) / counts.sum()
+    return {q: float(np.interp(q, cum, edges)) for q in quantiles}
+
+# Monte Carlo simulation of one pool position under correlated geometric brownian motion of both prices
+def simulatePool(numColEntry, priceCol, numAssEntry, priceAss, mu=(0.0, 0.0), sigma=(0.8, 0.05),
+                 corr=0.0, horizon=1.0, steps=1, nPaths=1000000, blockSize=100000, workers=None,
+                 seed=0, quantiles=(0.01, 0.05, 0.5, 0.95, 0.99), bins=20000):
+    '''
+    Assumes token amounts at pool entry and their prices (USD) at entry.
+    mu, sigma: Yearly drift and volatility of (collateral, asset). corr: Correlation of both.
+    horizon:   Years to simulate, in {steps} steps (worst il along the path needs steps > 1).
+    Paths are simulated in blocks of {blockSize} on a pool of {workers} processes (default:
+    all cores). Each block gets its own seed spawned from {seed}, so results don't depend
+    on the number of workers. Per block only histograms are kept and at most 2 blocks per
+    worker are in flight, so memory is fixed (about workers x (blockSize x 2 floats + 3
+    histograms)) no matter how many paths are simulated.
+    Pool value follows the constant-product invariant (k = numCol * numAss), fees not included.
+    Returns dict with quantiles (approximated by the histograms of {bins} bins) of:
+    'il' (at horizon), 'worstIl' (along the path), 'poolValue' (at horizon, USD),
+    and 'meanIl', 'meanPoolValue', 'paths'.
+    '''
+    # Get name of function for error messages (depends on inspect, sys)
+    funcName = inspect.currentframe().f_code.co_name
+    assert -1 <= corr <= 1, f'{funcName}(): corr must be between -1 and 1.'
+
+    amounts = np.array([numColEntry, numAssEntry], dtype=float)
+    logP0 = np.log([priceCol, priceAss])
+    mu, vol = np.asarray(mu, dtype=float), np.asarray(sigma, dtype=float)
+    drift = mu - vol**2 / 2
+    chol = np.linalg.cholesky(np.array([[1.0, corr], [corr, 1.0]]) + np.eye(2) * 1e-12)
+    dt = horizon / steps
+
+    sizes = [blockSize] * (nPaths // blockSize) + ([nPaths % blockSize] if nPaths % blockSize else [])
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    tasks = ((seedSeq, n, amounts, logP0, drift, vol, chol, steps, dt, bins) for seedSeq, n in zip(seeds, sizes))
+
+    # Possibility: One worker. Don't start processes.
+    if workers == 1:
+        results = map(_simulateBlock, tasks)
+        return _mergeSimulation(results, nPaths, amounts @ np.exp(logP0), quantiles, bins)
+
+    # At most 2 blocks per worker in flight, so finished histograms don't pile up for large nPaths
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = _orderedWindow(executor, _simulateBlock, tasks, 2 * (workers or os.cpu_count() or 1))
+        return _mergeSimulation(results, nPaths, amounts @ np.exp(logP0), quantiles, bins)
+
+# Helper function: Adds up block results of simulatePool() and returns its summary dict
+def _mergeSimulation(results, nPaths, entryValue, quantiles, bins):
+    total = None
+    for result in results:
+        if total is None:
+            total = result
+        else:
+            for key in total:
+                total[key] = total[key] + result[key]
+
+    valueQuantiles = _histQuantiles(total['valueHist'], *LOG_VALUE_RANGE, quantiles)
+    return {
+        'paths': nPaths,
+        'il': _histQuantiles(total['ilHist'], -1, 0, quantiles),
+        'worstIl': _histQuantiles(total['worstIlHist'], -1, 0, quantiles),
+        'poolValue': {q: float(entryValue * np.exp(v)) for q, v in valueQuantiles.items()},
+        'meanIl': float(total['sumIl'] / nPaths),
+        'meanPoolValue': float(total['sumValue'] / nPaths)
+        }
+
+# Long-running poller: Prices tokens on their own schedule and recomputes/saves only pools whose prices changed
+class PoolDaemon:
+    '''
+    Assumes nested dict of asset pairings containing 'colStr', 'assStr', 'numColEntry', 'numAssEntry'
+    (or a PoolTable).
+    provider:  PriceProvider (default: BulkPriceProvider() with a page fallback that revalidates
+               every poll instead of serving TOKEN_CACHE's prices for up to 60 seconds).
+    interval:  Seconds between two price polls of a token.
+    intervals: Dict {token: seconds} overriding interval for single tokens.
+    fileName / store: Where changed pools are saved (see updateCSV()). None: nothing is saved.
+    fees:      FeeAccumulator, updated every tick. Every tick, all pools with a known value then get
+               'fees' and 'poolValueInclFees' (like getPoolStatus(..., fees=fees)) and are saved,
+               since their fees grow even if no price changed.
+    volumes:   Callable returning vol24h (USD) per pair of fees.pairs, passed to fees.update()
+               every tick. None: fees accrue at the rates last set on the accumulator.
+    metricsFile: If set, METRICS are written to this file after every tick (see Metrics.write()),
+               so long runs can be scraped (i.e. by Prometheus' textfile collector).
+    Every tick asks the provider once for all tokens that are due (each token once, no
+    matter in how many pairs it is). Only pools with a changed price are recomputed and
+    (without fees) saved.
+    '''
+    def __init__(self, dataDict, provider=None, interval=60, intervals=None, fileName=None, store=None,
+                 roundTo=2, verbose=False, logfile=None, fees=None, volumes=None, metricsFile=None):
+        self.fileName = fileName
+        self.metricsFile = metricsFile
+        self.fees = fees
+        self.volumes = volumes
+        self.store = store
+        self.roundTo = roundTo
+        self.verbose = verbose
+        self.logfile = logfile
+
+        # Pools as column arrays, tokens as indices into self.tokens / self.prices
+        table = dataDict if isinstance(dataDict, PoolTable) else PoolTable.fromDict(dataDict)
+        self.pairs = table.keys
+        self.tokens = table.tokens
+        self.colIds = table['colId']
+        self.assIds = table['assId']
+        self.numColEntry = table['numColEntry']
+        self.numAssEntry = table['numAssEntry']
+
+        intervals = intervals or {}
+        self.intervals = np.array([intervals.get(tokenStr, interval) for tokenStr in self.tokens], dtype=float)
+
+        # Default provider: Token pages are never served from cache (ttl=0), only revalidated (ETag),
+        # so intervals shorter than TOKEN_CACHE.ttl still see new prices
+        if provider is None:
+            pageCache = TokenCache(ttl=0, maxSize=max(1, len(self.tokens)))
+            provider = BulkPriceProvider(fallback=PagePriceProvider(cache=pageCache))
+        self.provider = provider
+        self.prices = np.full(len(self.tokens), np.nan)
+        self.nextDue = np.zeros(len(self.tokens))
+        self.poolStatus = {}    # latest result per pair, like getPoolStatus()
+        self.poolValues = np.full(len(self.pairs), np.nan)    # latest unrounded poolValue per pair
+
+        self.ticks, self.recomputed, self.skipped = 0, 0, 0
+        self.lastTickSeconds = 0.0
+
+    def tick(self, now=None):
+        '''
+        Polls all due tokens, recomputes and saves pools whose prices changed.
+        Returns dict with duration of the tick and number of tokens polled / pools recomputed / skipped.
+        '''
+        start = monotonic()
+        now = monotonic() if now is None else now
+
+        # Ask provider once for all due tokens
+        due = np.flatnonzero(self.nextDue <= now)
+        changed = np.zeros(len(self.tokens), dtype=bool)
+        if len(due):
+            prices = self.provider.getPrices([self.tokens[i] for i in due])
+            for i in due:
+                price = prices.get(self.tokens[i])
+                if price is not None and price != self.prices[i]:
+                    self.prices[i] = price
+                    changed[i] = True
+            self.nextDue[due] = now + self.intervals[due]
+
+        # Option: Add fees earned since the last tick, take new volumes
+        if self.fees:
+            self.fees.update(self.volumes(self.fees.pairs) if self.volumes else None)
+
+        # Recompute only pools with a changed (and known) price of either token
+        mask = (changed[self.colIds] | changed[self.assIds]) & \
+            ~np.isnan(self.prices[self.colIds]) & ~np.isnan(self.prices[self.assIds])
+        idx = np.flatnonzero(mask)
+        updates = {}
+        if len(idx):
+            amtCol, amtAss, poolVal = balancePools(
+                self.numColEntry[idx], self.prices[self.colIds[idx]],
+                self.numAssEntry[idx], self.prices[self.assIds[idx]]
+                )
+            self.poolValues[idx] = poolVal
+            for i, val, col, ass in zip(idx.tolist(), poolVal.tolist(), amtCol.tolist(), amtAss.tolist()):
+                updates[self.pairs[i]] = {
+                    'poolValue': round(val, self.roundTo),
+                    'amtCol': round(col, self.roundTo),
+                    'amtAss': round(ass, self.roundTo)
+                    }
+            self.poolStatus.update(updates)
+        saved = list(updates)
+
+        # Option: Refresh accrued fees of all pools with a known value (in one step, fees grow every tick)
+        if self.fees:
+            known = np.flatnonzero(~np.isnan(self.poolValues))
+            saved = [self.pairs[i] for i in known.tolist()]
+            feeArr = self.fees.feesFor(saved)
+            inclFees = self.poolValues[known] + feeArr
+            for pair, fee, val in zip(saved, feeArr.tolist(), inclFees.tolist()):
+                self.poolStatus[pair]['fees'] = round(fee, self.roundTo)
+                self.poolStatus[pair]['poolValueInclFees'] = round(val, self.roundTo)
+
+        # Save changed pools only (with fees: all known pools)
+        if saved and (self.store or self.fileName):
+            varNames = ['token', 'poolValue', 'amtCol', 'amtAss']
+            if self.fees:
+                varNames += ['fees', 'poolValueInclFees']
+            rows = [[pair] + [self.poolStatus[pair][var] for var in varNames[1:]] for pair in saved]
+            if self.store:
+                self.store.append(rows, varNames)
+            else:
+                appendRows(self.fileName, rows, varNames, verbose=False)
+
+        self.ticks += 1
+        self.recomputed += len(idx)
+        self.skipped += len(self.pairs) - len(idx)
+        self.lastTickSeconds = monotonic() - start
+
+        tickStats = {'seconds': self.lastTickSeconds, 'polled': len(due),
+                     'recomputed': len(idx), 'skipped': len(self.pairs) - len(idx)}
+        if self.verbose:
+            print('PoolDaemon.tick(): %(seconds).3fs, polled %(polled)d tokens, '
+                  'recomputed %(recomputed)d pools, skipped %(skipped)d.' % tickStats)
+        if self.metricsFile:
+            METRICS.write(self.metricsFile)
+        return tickStats
+
+    def run(self, maxTicks=None):
+        '''
+        Ticks until interrupted (Ctrl+C) or after {maxTicks} ticks, sleeping until the next token is due.
+        '''
+        # Possibility: No pools. Nothing will ever be due.
+        if not len(self.tokens):
+            print('PoolDaemon.run(): No pools to watch.')
+            return self.stats()
+
+        try:
+            while maxTicks is None or self.ticks < maxTicks:
+                self.tick()
+                sleep(max(0.0, self.nextDue.min() - monotonic()))
+        except KeyboardInterrupt:
+            pass
+        if self.logfile:
+            log(self.logfile, 'PoolDaemon stopped: %s' % self.stats())
+        return self.stats()
+
+    def stats(self):
+        '''
+        Returns dict of counters since start.
+        '''
+        return {'ticks': self.ticks, 'recomputed': self.recomputed, 'skipped': self.skipped,
+                'lastTickSeconds': self.lastTickSeconds}
+
+# Column-oriented table of records (one row per pair or token), replacing nested dicts of dicts
+class RecordTable:
+    '''
+    keys:    List of row names (i.e. pairs or tokens).
+    columns: Dict {varName: array} with one value per row (float arrays for numbers).
+    Use fromDict() / toDict() to convert from / to nested dicts {key: {varName: value}}.
+    '''
+    __slots__ = ('keys', 'columns', '_index')
+
+    def __init__(self, keys, columns):
+        self.keys = list(keys)
+        self.columns = dict(columns)
+        self._index = None
+
+    @property
+    def index(self):
+        '''
+        Dict {key: row number}, built on first use.
+        '''
+        if self._index is None:
+            self._index = {key: i for i, key in enumerate(self.keys)}
+        return self._index
+
+    @classmethod
+    def fromDict(cls, d, varNames=None):
+        '''
+        Assumes nested dict {key: {varName: value}}. varNames: Columns to keep (default: all).
+        '''
+        keys = list(d)
+        if varNames is None:
+            varNames = list(dict.fromkeys(var for key in keys for var in d[key]))
+        columns = {}
+        for var in varNames:
+            values = [d[key].get(var) for key in keys]
+            numeric = all(isinstance(v, (int, float, np.number)) and not isinstance(v, bool) for v in values)
+            columns[var] = np.array(values, dtype=float if numeric else object)
+        return cls(keys, columns)
+
+    def toDict(self):
+        lists = {var: col.tolist() for var, col in self.columns.items()}
+        return {key: {var: lists[var][i] for var in lists} for i, key in enumerate(self.keys)}
+
+    def rows(self, varNames=None):
+        '''
+        Returns list of rows [key, value1, value2, ...] (Python scalars) for appendRows() / HistoryStore.
+        '''
+        varNames = varNames or list(self.columns)
+        lists = [self.columns[var].tolist() for var in varNames]
+        return [[key] + [col[i] for col in lists] for i, key in enumerate(self.keys)]
+
+    def take(self, mask):
+        '''
+        Returns a table with only the rows where mask (bool array, one value per row) is True.
+        '''
+        mask = np.asarray(mask, dtype=bool)
+        keys = [key for key, keep in zip(self.keys, mask.tolist()) if keep]
+        return RecordTable(keys, {var: col[mask] for var, col in self.columns.items()})
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, varName):
+        return self.columns[varName]
+
+    def __setitem__(self, varName, values):
+        self.columns[varName] = np.asarray(values)
+
+# Pool inputs as a table: token names interned to integer ids shared by all pairs
+class PoolTable(RecordTable):
+    '''
+    Columns: 'colId', 'assId' (indices into self.tokens), 'numColEntry', 'numAssEntry'
+    and, once known, 'priceCol', 'priceAss'. Accepted wherever a nested dict of token
+    pairs is (getPoolStatus(), addPrices(), createMetricsDict(), PoolDaemon).
+    '''
+    __slots__ = ('tokens', 'tokenIds')
+
+    def __init__(self, keys, columns, tokens):
+        super().__init__(keys, columns)
+        self.tokens = list(tokens)
+        self.tokenIds = {tokenStr: i for i, tokenStr in enumerate(self.tokens)}
+
+    @classmethod
+    def fromDict(cls, data):
+        '''
+        Assumes nested dict of token pairs containing 'colStr', 'assStr', 'numColEntry',
+        'numAssEntry' and optionally 'priceCol', 'priceAss'.
+        '''
+        pairs = list(data)
+        tokens = list(dict.fromkeys(data[pair][key] for pair in pairs for key in ('colStr', 'assStr')))
+        tokenIds = {tokenStr: i for i, tokenStr in enumerate(tokens)}
+        columns = {
+            'colId': np.array([tokenIds[data[pair]['colStr']] for pair in pairs], dtype=np.intp),
+            'assId': np.array([tokenIds[data[pair]['assStr']] for pair in pairs], dtype=np.intp)
+            }
+        for key in ['numColEntry', 'numAssEntry', 'priceCol', 'priceAss']:
+            if all(key in data[pair] for pair in pairs):
+                columns[key] = np.array([data[pair][key] for pair in pairs], dtype=float)
+        return cls(pairs, columns, tokens)
+
+    def toDict(self):
+        poolDict = super().toDict()
+        for pair, d in poolDict.items():
+            d['colStr'] = self.tokens[d.pop('colId')]
+            d['assStr'] = self.tokens[d.pop('assId')]
+        return poolDict
+
+    def take(self, mask):
+        table = super().take(mask)
+        return PoolTable(table.keys, table.columns, self.tokens)
+
+    def setPrices(self, prices):
+        '''
+        Sets 'priceCol' and 'priceAss' from prices per token: dict {token: priceUSD} or
+        array aligned with self.tokens. Returns self.
+        '''
+        if isinstance(prices, dict):
+            prices = np.array([prices.get(tokenStr, np.nan) for tokenStr in self.tokens], dtype=float)
+        prices = np.asarray(prices, dtype=float)
+        self.columns['priceCol'] = prices[self.columns['colId']]
+        self.columns['priceAss'] = prices[self.columns['assId']]
+        return self
+
+# Running estimate of fees earned per pool, updated incrementally every tick
+class FeeAccumulator:
+    '''
+    Estimates fee income of many pool positions from their pool's trading volume:
+        fees per second = vol24h * feeTier * poolShare / 86400
+    vol24h:    Trading volume of the pool (USD per 24h).
+    feeTier:   Fee per trade, i.e. 0.003 for 0.3%.
+    poolShare: Position's share of the pool's liquidity (0..1).
+    update() adds the fees earned since the last update at the last known rate, then
+    takes the new volume. State is a few float arrays with one entry per pool, so all
+    pools are updated in one vectorized step and nothing depends on the history length.
+    '''
+    def __init__(self, pairs, feeTier, poolShare, now=None):
+        self.pairs = list(pairs)
+        self.index = {pair: i for i, pair in enumerate(self.pairs)}
+        n = len(self.pairs)
+        self.feeTier = np.broadcast_to(np.asarray(feeTier, dtype=float), (n,)).copy()
+        self.poolShare = np.broadcast_to(np.asarray(poolShare, dtype=float), (n,)).copy()
+        self.rate = np.zeros(n)       # USD per second
+        self.accrued = np.zeros(n)    # USD earned so far
+        self.lastUpdate = time() if now is None else now
+
+    @classmethod
+    def fromPoolData(cls, data, now=None):
+        '''
+        Assumes nested dict of token pairs, each containing 'feeTier' and 'poolShare'.
+        '''
+        pairs = list(data)
+        return cls(pairs, [data[pair]['feeTier'] for pair in pairs],
+                   [data[pair]['poolShare'] for pair in pairs], now=now)
+
+    def update(self, vol24h=None, now=None, poolShare=None):
+        '''
+        Adds fees since the last update, then sets new rates from vol24h (array, one value per
+        pool; None keeps the last rates) and poolShare (None keeps the last shares).
+        Returns array of accrued fees.
+        '''
+        now = time() if now is None else now
+        self.accrued += self.rate * max(0.0, now - self.lastUpdate)
+        self.lastUpdate = now
+
+        if poolShare is not None:
+            self.poolShare[:] = poolShare
+        if vol24h is not None:
+            self.rate = np.asarray(vol24h, dtype=float) * self.feeTier * self.poolShare / 86400
+
+        return self.accrued
+
+    def feesFor(self, pairs):
+        '''
+        Returns array of accrued fees for the given pairs (0 for pairs not tracked).
+        '''
+        idx = np.array([self.index.get(pair, -1) for pair in pairs], dtype=np.intp)
+
+        # Possibility: No pairs tracked (or asked). Nothing to index.
+        if not len(self.pairs) or not len(idx):
+            return np.zeros(len(idx))
+        return np.where(idx >= 0, self.accrued[idx], 0.0)
+
+    def save(self, fileName):
+        '''
+        Saves state to a .npz file (see load()).
+        '''
+        np.savez(fileName, pairs=np.array(self.pairs), feeTier=self.feeTier, poolShare=self.poolShare,
+                 rate=self.rate, accrued=self.accrued, lastUpdate=self.lastUpdate)
+
+    @classmethod
+    def load(cls, fileName):
+        '''
+        Returns FeeAccumulator saved with save().
+        '''
+        with np.load(fileName) as state:
+            acc = cls(state['pairs'].tolist(), state['feeTier'], state['poolShare'],
+                      now=float(state['lastUpdate']))
+            acc.rate = state['rate'].copy()
+            acc.accrued = state['accrued'].copy()
+        return acc
+
+# Precomputes sqrt-price bounds and liquidity of concentrated-liquidity (Uniswap v3 style) positions
+def rangeLiquidity(numColEntry, priceCol, numAssEntry, priceAss, lower, upper):
+    '''
+    Assumes array-likes (one value per position) of token amounts and usd prices at entry,
+    and the price range [lower, upper] of each position, given as price of collateral in
+    units of asset (priceCol / priceAss), like the ranges shown by Uniswap.
+    Returns tuple of arrays (sqrtLower, sqrtUpper, liquidity) for rangeAmounts().
+    Amounts that don't fit the entry price exactly are capped (the excess isn't in the pool).
+    '''
+    numColEntry = np.asarray(numColEntry, dtype=float)
+    numAssEntry = np.asarray(numAssEntry, dtype=float)
+    sqrtLower = np.sqrt(np.asarray(lower, dtype=float))
+    sqrtUpper = np.sqrt(np.asarray(upper, dtype=float))
+    sqrtP = np.clip(np.sqrt(np.asarray(priceCol, dtype=float) / np.asarray(priceAss, dtype=float)),
+                    sqrtLower, sqrtUpper)
+
+    # Liquidity each token amount could provide (inf if the position doesn't need that token)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        liqCol = np.where(sqrtP < sqrtUpper, numColEntry * sqrtP * sqrtUpper / (sqrtUpper - sqrtP), np.inf)
+        liqAss = np.where(sqrtP > sqrtLower, numAssEntry / (sqrtP - sqrtLower), np.inf)
+
+    return sqrtLower, sqrtUpper, np.minimum(liqCol, liqAss)
+
+# Returns current amounts and values of concentrated-liquidity positions (vectorized)
+def rangeAmounts(sqrtLower, sqrtUpper, liquidity, priceCol, priceAss):
+    '''
+    Assumes arrays from rangeLiquidity() and current usd prices (broadcast like balancePools(),
+    i.e. prices of shape (nShocks, nPositions) for price scenarios).
+    Returns tuple of arrays (amtCol, amtAss, poolValue, inRange). Below the range a position
+    holds only collateral, above it only asset. Fees aren't factored in.
+    '''
+    priceCol = np.asarray(priceCol, dtype=float)
+    priceAss = np.asarray(priceAss, dtype=float)
+    sqrtPrice = np.sqrt(priceCol / priceAss)
+    sqrtP = np.clip(sqrtPrice, sqrtLower, sqrtUpper)
+
+    amtCol = liquidity * (sqrtUpper - sqrtP) / (sqrtP * sqrtUpper)
+    amtAss = liquidity * (sqrtP - sqrtLower)
+    poolVal = amtCol * priceCol + amtAss * priceAss
+    inRange = (sqrtPrice >= sqrtLower) & (sqrtPrice <= sqrtUpper)
+
+    return amtCol, amtAss, poolVal, inRange
+
+# Returns current amounts and values of weighted-pool (Balancer style) positions (vectorized)
+def weightedPoolAmounts(balances, weights, prices):
+    '''
+    Assumes arrays of shape (nPositions, nTokens): token amounts at entry, token weights
+    (summing to 1 per position) and current usd prices (prices may have extra leading axes
+    for price scenarios). The invariant prod(balance ** weight) stays constant, and after
+    arbitrage every token makes up its weight of the pool value:
+        poolValue = prod((price / weight) ** weight) * invariant,  amount = weight * poolValue / price
+    Returns tuple (amounts, poolValue) of shapes (..., nPositions, nTokens) and (..., nPositions).
+    With weights 0.5 / 0.5 this is the constant-product pool. Fees aren't factored in.
+    '''
+    balances = np.asarray(balances, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    prices = np.asarray(prices, dtype=float)
+
+    # In logs, so many tokens / big numbers don't overflow
+    logInvariant = (weights * np.log(balances)).sum(axis=-1)
+    logValue = logInvariant + (weights * (np.log(prices) - np.log(weights))).sum(axis=-1)
+    poolVal = np.exp(logValue)
+
+    return weights * poolVal[..., np.newaxis] / prices, poolVal
+
 # Helper function: Removes any '$', '%', and ',' from target string and converts to float
 def clean(string):
     # Abort if scraped metric is empty or None
-    assert string not in {None, ''}, \
-        f"""
-        Coingecko seems to have restructured their website.
-        One of the metrics couldn't be scraped. Check {funcName}().
-        """
+    if string in {None, ''}:
+        raise ValueError(
+            f"clean(): Got {string!r} instead of a number. Coingecko seems to have restructured "
+            "their website, one of the metrics couldn't be scraped."
+            )
     return float(string.replace(',','').replace('$','').replace('%',''))
 
 # Cycles through all table rows of a website and returns [integer from] first [matching] row/cell
+@timedStage('findCell')
 def findCell(tableRows, rowKw, cellKw=None, getRawRow=False, stripToInt=True):
     '''
     Assumes tableRows = bs.findAll('tr').
-    Cycles through all table rows / cells of a website and returns a match
+    Cycles through all table rows / cells of a website and returns a match.
+    For many lookups on the same page, use RowIndex (no rescan per lookup).
     
     If no cellKw set:    Returns 1st matching row. 
     If cellKw set:       Returns first matching cell within that row.
@@ -155,63 +1607,287 @@ def findCell(tableRows, rowKw, cellKw=None, getRawRow=False, stripToInt=True):
     funcName = inspect.currentframe().f_code.co_name
     result = None
 
-    for row in tableRows:
-        
-        # Possibility no cellKw: Return the first row containing rowKw
-        if rowKw in row.get_text():
-            result = str(row)
-            
-            # Possibility getRaw: Return raw bs.Tag object
-            if getRawRow and result and not cellKw:
-                result = row
-                stripToInt = False
-            
-    # Possibility cellKw: Return the first cell containing cellKw
-    if cellKw and result:
-        sCell = [str(cell) for cell in row if cellKw in result][0]
-        result = sCell
-                
-    # Possibility stripToInt: Extract integers and return int
-    if stripToInt and result:
+    for row in tableRows:
+        
+        # Possibility no cellKw: Return the first row containing rowKw
+        if rowKw in row.get_text():
+            result = str(row)
+            
+            # Possibility getRaw: Return raw bs.Tag object
+            if getRawRow and result and not cellKw:
+                result = row
+                stripToInt = False
+            break
+            
+    # Possibility cellKw: Return the first cell containing cellKw
+    if cellKw and result:
+        sCells = [str(cell) for cell in row if cellKw in str(cell)]
+        result = sCells[0] if sCells else None
+                
+    # Possibility stripToInt: Extract integers and return int
+    if stripToInt and result:
+        try:
+            n = int(''.join(filter(lambda i: i.isdigit(), result)))
+            result = n
+        except ValueError:
+            print( \
+            f'''
+            {funcName}():
+            There are no digits in the first row containing '{rowKw}' and
+            its first cell containing '{cellKw}'.
+            ''')
+    
+    # Possibility: No rows found matching rowKw
+    if not result:
+        print(f'{funcName}(): No rows found containing {rowKw}!')
+    return result    
+
+# Helper function: Returns lower case text with whitespace collapsed (to compare row labels)
+def _normalizeLabel(text):
+    return ' '.join(text.split()).lower()
+
+# Index of the table rows of one page, built once: normalized row label -> row and its cells
+class RowIndex:
+    '''
+    Assumes tableRows = bs.findAll('tr') or extractTags(...)['rows'].
+    Label of a row = text of its first th/td cell, values = texts of the other cells.
+    If several rows have the same label, the first one wins.
+
+    Example:
+                >>>RowIndex(tableRows).cell('Market Cap Rank')
+                >>>2
+    '''
+    @timedStage('findCell')
+    def __init__(self, tableRows):
+        self.rows = {}       # {label: {'row': tag, 'cells': [cell texts]}}
+        self._matches = {}   # {keyword: label of first row containing it}
+        for row in tableRows:
+            cells = [cell for cell in row if getattr(cell, 'name', None) in {'th', 'td'}]
+            if not cells:
+                continue
+            label = _normalizeLabel(cells[0].get_text())
+            if label not in self.rows:
+                self.rows[label] = {'row': row, 'cells': [cell.get_text().strip() for cell in cells[1:]]}
+
+    def find(self, rowKw):
+        '''
+        Returns {'row', 'cells'} of the row labeled rowKw or else of the first row whose
+        label contains rowKw (None if there is none). Case and whitespace are ignored.
+        '''
+        key = _normalizeLabel(rowKw)
+        if key in self.rows:
+            return self.rows[key]
+
+        # Possibility: No exact label. Look for first label containing rowKw (once per keyword).
+        if key not in self._matches:
+            self._matches[key] = next((label for label in self.rows if key in label), None)
+        label = self._matches[key]
+        return self.rows[label] if label is not None else None
+
+    @timedStage('findCell')
+    def cell(self, rowKw, cellKw=None, stripToInt=True):
+        '''
+        Returns first value cell (text) of the matching row, or its first cell containing cellKw.
+        If stripToInt: Returns int (all digits within that cell).
+        Returns None if there is no such row / cell.
+        '''
+        funcName = 'RowIndex.cell'
+        entry = self.find(rowKw)
+        if not entry:
+            print(f'{funcName}(): No rows found containing {rowKw}!')
+            return None
+
+        cells = [cell for cell in entry['cells'] if cellKw is None or cellKw in cell]
+        if not cells:
+            print(f"{funcName}(): No cell containing '{cellKw}' in row '{rowKw}'!")
+            return None
+        result = cells[0]
+
+        # Possibility stripToInt: Extract integers and return int
+        if stripToInt:
+            digits = ''.join(filter(lambda i: i.isdigit(), result))
+            if not digits:
+                print(f"{funcName}(): There are no digits in row '{rowKw}', cell '{result}'.")
+                return None
+            result = int(digits)
+
+        return result
+
+# Tags getTokenMetrics() needs from a token page: {key: (tag name, required class or None)}
+TOKEN_PAGE_TAGS = {
+    'noWrap': ('span', 'no-wrap'),
+    'mt1': ('div', 'mt-1'),
+    'rows': ('tr', None)
+    }
+
+# Elements that never have an end tag (see _TagCollector)
+VOID_ELEMENTS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta',
+                 'param', 'source', 'track', 'wbr'}
+
+# Elements whose text bs4's get_text() leaves out when they are nested in the element asked
+NON_TEXT_ELEMENTS = {'script', 'style', 'template'}
+
+# Minimal stand-in for a bs4 Tag, as created by _TagCollector
+class _Tag:
+    '''
+    Supports what the scraping functions use of bs4 Tags: get(), get_text(), str() and
+    iterating over / indexing the direct children (strings and _Tags).
+    '''
+    __slots__ = ('name', 'attrs', 'contents')
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.contents = []
+
+    def get(self, key, default=None):
+        return self.attrs.get(key, default)
+
+    def get_text(self):
+        # Like bs4: Text of nested script/style/template elements is left out (but not of the element itself)
+        return ''.join(
+            child if type(child) == str else child.get_text()
+            for child in self.contents
+            if not isinstance(child, _Comment) and getattr(child, 'name', None) not in NON_TEXT_ELEMENTS
+            )
+
+    def __iter__(self):
+        return iter(self.contents)
+
+    def __getitem__(self, key):
+        return self.attrs[key]
+
+    def __str__(self):
+        attrs = ''.join(' %s="%s"' % (k, v.replace('&', '&amp;').replace('"', '&quot;'))
+                        for k, v in self.attrs.items())
+        if self.name in VOID_ELEMENTS:
+            return '<%s%s/>' % (self.name, attrs)
+        inner = ''.join(
+            child.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+            if type(child) == str else str(child)
+            for child in self.contents
+            )
+        return '<%s%s>%s</%s>' % (self.name, attrs, inner, self.name)
+
+class _Comment(str):
+    def __str__(self):
+        return '<!--%s-->' % str.__str__(self)
+
+# Streaming tokenizer that builds _Tags only for the requested elements (and their children)
+class _TagCollector(HTMLParser):
+    '''
+    Collects all elements matching targets ({key: (tag name, class or None)}) in document
+    order, in a single pass and without building a tree for the rest of the page.
+    '''
+    def __init__(self, targets):
+        super().__init__(convert_charrefs=True)
+        self.targets = targets
+        self.found = {key: [] for key in targets}
+        self.stack = []    # open _Tags that are (within) a requested element
+        self.open = []     # (name, len(self.stack) when opened) of all open elements
+
+    def handle_starttag(self, tag, attrs):
+        attrs = {k: '' if v is None else v for k, v in attrs}
+        matches = [
+            key for key, (name, cls) in self.targets.items()
+            if tag == name and (cls is None or cls in attrs.get('class', '').split())
+            ]
+        if tag not in VOID_ELEMENTS:
+            self.open.append((tag, len(self.stack)))
+        if not matches and not self.stack:
+            return
+
+        element = _Tag(tag, attrs)
+        if self.stack:
+            self.stack[-1].contents.append(element)
+        for key in matches:
+            self.found[key].append(element)
+        if tag not in VOID_ELEMENTS:
+            self.stack.append(element)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_ELEMENTS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        # Like bs4: Close the most recent open element of that name and everything opened within it,
+        # even if that element itself isn't collected. End tags without open element are ignored.
+        for i in range(len(self.open) - 1, -1, -1):
+            if self.open[i][0] == tag:
+                del self.stack[self.open[i][1]:]
+                del self.open[i:]
+                break
+
+    def handle_data(self, data):
+        if self.stack:
+            contents = self.stack[-1].contents
+            if contents and type(contents[-1]) == str:
+                contents[-1] += data
+            else:
+                contents.append(data)
+
+    def handle_comment(self, data):
+        if self.stack:
+            self.stack[-1].contents.append(_Comment(data))
+
+# Extractor backends: Return {key: [tags]} for targets ({key: (tag name, class or None)})
+def _extractBs4(html, targets):
+    from bs4 import BeautifulSoup
+    bs = BeautifulSoup(html, 'html.parser')
+    return {
+        key: bs.findAll(name, {'class': cls}) if cls else bs.findAll(name)
+        for key, (name, cls) in targets.items()
+        }
+
+def _extractStream(html, targets):
+    if isinstance(html, bytes):
         try:
-            n = int(''.join(filter(lambda i: i.isdigit(), result)))
-            result = n
-        except ValueError:
-            print( \
-            f'''
-            {funcName}():
-            There are no digits in the first row containing '{rowKw}' and
-            its first cell containing '{cellKw}'.
-            ''')
-    
-    # Possibility: No rows found matching rowKw
-    if not result:
-        print(f'{funcName}(): No rows found containing {rowKw}!')
-    return result    
+            html = html.decode('utf-8')
+        except UnicodeDecodeError:
+            from bs4.dammit import UnicodeDammit
+            html = UnicodeDammit(html).unicode_markup
+    collector = _TagCollector(targets)
+    collector.feed(html)
+    collector.close()
+    return collector.found
 
-# Scrapes coingecko and returns dict of various token metrics for 1 asset (calls findCell() for mc rank)
-def getTokenMetrics(tokenStr, logfile=None, waitAfter=3):
+# Available backends for extractTags(). Register custom ones here.
+# 'bs4':    Full BeautifulSoup tree (slow, reference implementation).
+# 'stream': Single pass of a tokenizer, only builds the requested elements.
+EXTRACTORS = {'bs4': _extractBs4, 'stream': _extractStream}
+EXTRACTOR = 'stream'
+
+# Returns all requested html elements of a page (parsed with the chosen backend)
+@timedStage('parse')
+def extractTags(html, targets, extractor=None):
     '''
-    Assumes a string matching an existing html child of 'coingecko.com/en/coins/', i.e. 'ethereum'.
-    Returns a dict of current asset metrics as given on coingecko.com.
+    Assumes html (str or bytes) and dict of targets {key: (tag name, class or None)}.
+    Returns dict {key: list of matching tags in document order}, like bs.findAll().
+    extractor: Name of a backend in EXTRACTORS. Defaults to EXTRACTOR.
+    '''
+    extractor = extractor or EXTRACTOR
+    assert extractor in EXTRACTORS, \
+        f'extractTags(): Unknown extractor {extractor!r}. Choose one of {list(EXTRACTORS)}.'
+    return EXTRACTORS[extractor](html, targets)
+
+# Parses a token page from coingecko and returns dict of various token metrics (uses RowIndex for mc rank)
+def extractTokenMetrics(html, tokenStr, logfile=None, extractor=None):
+    '''
+    Assumes html (str or bytes) of 'coingecko.com/en/coins/{tokenStr}'.
+    Returns a dict of current asset metrics as given on the page.
+    extractor: Name of a backend in EXTRACTORS. Defaults to EXTRACTOR.
     '''
-    
     # Get name of function for error messages (depends on inspect, sys)
     funcName = inspect.currentframe().f_code.co_name
     tokenDict = {}
-    
-    # Scrape coingecko content for given token
-    url = 'https://www.coingecko.com/en/coins/' + tokenStr
-    userAgent = 'Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko)' + \
-        ' Chrome/41.0.2228.0 Safari/537.36'
-    req = urllib.request.Request(url, headers= {'User-Agent' : userAgent})
-    html = urllib.request.urlopen(req)
-    bs = BeautifulSoup(html.read(), 'html.parser')
-    
-    # Load necessary html tag result sets
-    noWrapTags = bs.findAll('span', {'class': 'no-wrap'})  # list of html tags
-    mt1Tags = bs.findAll('div', {'class': 'mt-1'}) 
-    tableRows = bs.findAll('tr')
+
+    # Load necessary html tag result sets (in one pass over the page)
+    tags = extractTags(html, TOKEN_PAGE_TAGS, extractor=extractor)
+    noWrapTags = tags['noWrap']  # list of html tags
+    mt1Tags = tags['mt1']
+    tableRows = tags['rows']
+    rowIndex = RowIndex(tableRows)    # for all metrics from the page's tables
 
     # Extract metrics that need html tag key attribute or other special treatment
     try:
@@ -219,7 +1895,7 @@ def getTokenMetrics(tokenStr, logfile=None, waitAfter=3):
         priceBTC = float(noWrapTags[0].get('data-price-btc'))
         mcBTC = float(noWrapTags[1].get('data-price-btc'))
         circSupply = float(mt1Tags[6].get_text().split('/')[0].strip().replace(',',''))
-        mcRank = findCell(tableRows, 'Rank', stripToInt=True)
+        mcRank = rowIndex.cell('Rank', stripToInt=True)
 
         # If supply is infinite (as in ETH), replace with inf
         try:
@@ -227,14 +1903,12 @@ def getTokenMetrics(tokenStr, logfile=None, waitAfter=3):
         except ValueError:
             totalSupply = np.inf
         
-    # Possibility: str-to-float conversion failed because it got None as argument 
+    # Possibility: str-to-float conversion failed because it got None as argument
     except TypeError:
-        print(f"""
-            Coingecko seems to have restructured their website.
-            One of these metrics couldn't be scraped:
-            {manuallyScraped}
-            Check {funcName}().
-            """)
+        raise ValueError(
+            f"{funcName}(): Coingecko seems to have restructured their website. "
+            f"One of these metrics couldn't be scraped for '{tokenStr}': {manuallyScraped}"
+            ) from None
     
     # Extract all other metrics from text and add all to the dict
     tokenDict['priceUSD'] = clean(noWrapTags[0].get_text())
@@ -262,79 +1936,211 @@ def getTokenMetrics(tokenStr, logfile=None, waitAfter=3):
             if type(metric) not in allowedTypes:
                 message = f"Check {funcName}(): Scraped value for '{tokenStr}': '{key}' is '{metric}', which is not a number."
                 log(logfile, message)
+
+    return tokenDict
+
+# Scrapes coingecko and returns dict of various token metrics for 1 asset (see extractTokenMetrics())
+def getTokenMetrics(tokenStr, logfile=None, waitAfter=3, rateLimiter=None, timeout=10, retries=3,
+                    cache=None, extractor=None):
+    '''
+    Assumes a string matching an existing html child of 'coingecko.com/en/coins/', i.e. 'ethereum'.
+    Returns a dict of current asset metrics as given on coingecko.com.
+    rateLimiter: If a RateLimiter is given, it spaces out requests instead of sleeping afterwards.
+    timeout, retries: Passed to fetchPage().
+    cache: TokenCache to use. Defaults to TOKEN_CACHE, False disables caching.
+           Fresh results are returned right away (no request, no sleep).
+    extractor: See extractTokenMetrics().
+    '''
     
+    tokenDict = {}
+
+    # Possibility: Token was scraped less than cache.ttl seconds ago. Return cached metrics.
+    if cache is None:
+        cache = TOKEN_CACHE
+    if cache:
+        tokenDict = cache.getFresh(tokenStr)
+        if tokenDict is not None:
+            return tokenDict
+        tokenDict = {}
+
+    # Scrape coingecko content for given token (conditional request if cache has an old version)
+    url = BASE_URL + '/coins/' + tokenStr
+    status, responseHeaders, html = fetchPage(
+        url, timeout=timeout, retries=retries, rateLimiter=rateLimiter,
+        headers=cache.validators(tokenStr) if cache else None, returnResponse=True
+        )
+
+    # Possibility: Page hasn't changed since last scrape. Skip parsing.
+    if status == 304:
+        tokenDict = cache.revalidate(tokenStr)
+        if tokenDict is not None:
+            if not rateLimiter:
+                sleep(random.random() * waitAfter)
+            return tokenDict
+
+        # Possibility: Cached entry was evicted while waiting for the answer. Download the page again.
+        status, responseHeaders, html = fetchPage(url, timeout=timeout, retries=retries,
+                                                  rateLimiter=rateLimiter, returnResponse=True)
+
+    tokenDict = extractTokenMetrics(html, tokenStr, logfile=logfile, extractor=extractor)
+
+    if cache:
+        cache.put(tokenStr, tokenDict, responseHeaders)
+
     # Wait for max {waitAfter} seconds before function can be called again (= scrape in a nice way)
-    sleep(random.random() * waitAfter)
+    if not rateLimiter:
+        sleep(random.random() * waitAfter)
     
     return tokenDict
 
 # Iterates over pairs in dataDict, calls getTokenMetrics for each asset and returns a dict metrics per token
-def createMetricsDict(dataDict, verbose=True, logfile=None):
+def createMetricsDict(dataDict, verbose=True, logfile=None, workers=None, rateLimit=1.0, burst=1,
+                      timeout=10, retries=3, asTable=False):
     '''
     Assumes nested dict of asset pairings containing 'colStr' and 'assStr' respectively.
     Scrapes current data from coingecko for each asset of each pair.
     Returns a dict of scraped metrics per token.
+    workers: If set, scrapes up to {workers} tokens at the same time. Instead of sleeping
+             after each scrape, all requests then share one RateLimiter allowing {rateLimit}
+             requests per second and host (bursts of {burst}). Tokens that still fail
+             after {retries} retries, or whose page can't be parsed, are reported and
+             left out of the result.
+    asTable: Returns a RecordTable (one row per token) instead of a nested dict.
+    dataDict may also be a PoolTable.
     '''
+    # Get name of function for error messages (depends on inspect, sys)
+    funcName = inspect.currentframe().f_code.co_name
     tokenData = {}
-    
-    # Cycle through token pairings as given in input dict
-    for pair in dataDict.keys():
 
-        # Get names of each token from pair
-        tokens = (dataDict[pair]['colStr'], dataDict[pair]['assStr'])
-        
-        # If already scraped: Don't scrape again.
+    # Collect names of all tokens as given in input dict (if in several pairs: scrape only once)
+    if isinstance(dataDict, PoolTable):
+        tokens = list(dataDict.tokens)
+    else:
+        tokens = []
+        for pair in dataDict.keys():
+            for tokenStr in (dataDict[pair]['colStr'], dataDict[pair]['assStr']):
+                if tokenStr not in tokens:
+                    tokens.append(tokenStr)
+
+    # Possibility: No workers set. Scrape one token after another.
+    if not workers:
         for tokenStr in tokens:
-            if tokenStr not in tokenData.keys():
 
-                # Scrape token data from coingecko and store in dict
-                tokenDict = getTokenMetrics(tokenStr, logfile=logfile)
-                tokenData[tokenStr] = tokenDict
-    
+            # Scrape token data from coingecko and store in dict
+            tokenDict = getTokenMetrics(tokenStr, logfile=logfile, timeout=timeout, retries=retries)
+            tokenData[tokenStr] = tokenDict
+
+            if verbose:
+                print('Successfully scraped price data for %s from Coingecko.' % tokenStr)
+
+    # Possibility: workers set. Scrape concurrently, spaced out by a shared rate limiter.
+    else:
+        rateLimiter = RateLimiter(rateLimit, burst)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(getTokenMetrics, tokenStr, logfile=logfile, rateLimiter=rateLimiter,
+                                timeout=timeout, retries=retries): tokenStr
+                for tokenStr in tokens
+                }
+            for future in as_completed(futures):
+                tokenStr = futures[future]
+                try:
+                    tokenData[tokenStr] = future.result()
+                except (OSError, http.client.HTTPException) as e:
+                    message = f"{funcName}(): Couldn't scrape '{tokenStr}' from Coingecko: {e!r}"
+                    print(message)
+                    if logfile:
+                        log(logfile, message)
+                    continue
+
+                # Possibility: Page was downloaded, but couldn't be parsed (i.e. an error page). Skip token.
+                except (IndexError, ValueError) as e:
+                    message = f"{funcName}(): Couldn't parse the page of '{tokenStr}': {e!r}"
+                    print(message)
+                    if logfile:
+                        log(logfile, message)
+                    continue
+
                 if verbose:
                     print('Successfully scraped price data for %s from Coingecko.' % tokenStr)
-                    
+
+        # Keep tokens in the same order as in dataDict
+        tokenData = {tokenStr: tokenData[tokenStr] for tokenStr in tokens if tokenStr in tokenData}
+
+    if asTable:
+        return RecordTable.fromDict(tokenData)
     return tokenData
 
-# Appends a new row to csv as specified in fileName
-def appendToCsv(fileName, varList, varNames, verbose=True):
+# Header width and last id per csv file written by appendRows(), with the file's size and mtime
+# when they were read. Lets appends skip reading the file as long as nobody else changed it.
+_csvState = {}
+
+# Helper function: Returns the last line of a file by seeking backwards from its end
+def _tailLine(fileName, chunkSize=4096):
+    with open(fileName, 'rb') as file:
+        file.seek(0, os.SEEK_END)
+        end = file.tell()
+        pos, tail = end, b''
+        while pos > 0:
+            pos = max(0, pos - chunkSize)
+            file.seek(pos)
+            tail = file.read(end - pos)
+            if b'\n' in tail.rstrip(b'\n'):
+                break
+    return tail.rstrip(b'\n').split(b'\n')[-1].decode()
+
+# Helper function: Returns (number of header fields, last id) of an existing csv
+def _csvHeaderAndLastId(fileName):
+    path = os.path.abspath(fileName)
+    stat = os.stat(path)
+    state = _csvState.get(path)
+
+    # Possibility: File changed since we last wrote to it (or never seen). Read header and last line.
+    if not state or (state['size'], state['mtime']) != (stat.st_size, stat.st_mtime_ns):
+        with open(path, 'r') as infile:
+            header = infile.readline()
+        lastLine = _tailLine(path)
+        try:
+            lastId = int(lastLine.split(',')[0])
+        except ValueError:
+            lastId = None
+        state = {'nHeader': len(header.split(',')), 'lastId': lastId,
+                 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+        _csvState[path] = state
+
+    return state['nHeader'], state['lastId']
+
+# Appends rows to csv as specified in fileName (one buffered write, constant cost regardless of file size)
+@timedStage('appendToCsv')
+def appendRows(fileName, rows, varNames, verbose=True):
     '''
-    Appends each value in varList as a new row to a file as specified in fileName.
-    Creates new file with header if not found in working dir.
-    Aborts with error message if it would change shape[1] of csv (= number of vars per row).
-    
-    Format of header:    id,time,[varNames]
-    Example for row:     0,2021 Feb 18 16:24,0.03,72,NaN,Yes,...
-    
-    1st value: Successive id (=first value in last row of file + 1).
-    2nd value: The current time in format "2021 Feb 18 17:34"
-    If there is no file yet: Creates file with header = id, timestamp, [varNames]
+    Like appendToCsv(), but appends several rows (list of varLists) at once.
+    All rows get the same timestamp and successive ids. They are written with a single
+    write() followed by fsync(). Header width and last id are kept in memory, so the
+    file is only read (header line + last line) if it has been changed by someone else.
+    Returns list of rows added (str, each starting with '\n').
     '''
-    
     # Get name of function for error messages (depends on inspect, sys)
     funcName = inspect.currentframe().f_code.co_name
-    
+
     # Abort if number of variables and names don't add up.
-    assert len(varList) == len(varNames), \
-        f"{funcName}(): The number of variables and names to append to csv must be the same."
-    
+    for varList in rows:
+        assert len(varList) == len(varNames), \
+            f"{funcName}(): The number of variables and names to append to csv must be the same."
+
     rowsAdded = []
-    
+    if not rows:
+        return rowsAdded
+
     # Get current time.
     timestamp = datetime.now()
     parsedTime = timestamp.strftime('%Y %b %d %H:%M')
+    path = os.path.abspath(fileName)
 
-    # Possibility: fileName doesn't exist yet. Create file with header and data.
-    if not os.path.isfile(fileName):
+    # Possibility: fileName doesn't exist yet (or is empty). Create file with header and data.
+    if not os.path.isfile(path) or os.path.getsize(path) == 0:
         header = 'id,' + 'time,' + str(','.join(varNames))
-        
-        with open(fileName, 'a') as wfile:
-            wfile.write(header)
-            varList = [str(var) for var in varList]
-            row = '\n' + '0' + ',' + parsedTime + ',' + str(','.join(varList))
-            wfile.write(row)
-            rowsAdded.append(row)
-            
+        text, nextId = header, 0
         if verbose:
             print(
             '''
@@ -342,177 +2148,739 @@ def appendToCsv(fileName, varList, varNames, verbose=True):
             Header:
             %s
             ''' % (fileName, header))
-            print('Added new row to data: \t', row[1:]) 
 
     # Possibility: fileName exists. Only append new data.
     else:
-        
+        n_header, lastId = _csvHeaderAndLastId(path)
+
         # Abort if number of variables to append differs from number of elements in csv header.
-        with open(fileName, 'r') as infile:
-            header = infile.readlines()[0]
-            n_header = len(header.split(','))
-            
-        assert len(varList) + 2 == n_header, \
+        assert len(varNames) + 2 == n_header, \
             f"""
-            {funcName}(): You're trying to append a row of {len(varList)} variables to csv.
+            {funcName}(): You're trying to append a row of {len(varNames)} variables to csv.
             In the csv header there are {n_header}. To be imported as pandas dataframe for analytics,
             the number of variables per row in the csv needs to stay consistent throughout all rows.
             """
-        
-        # Determine new id value based on most recent line of file.
-        with open(fileName, 'r') as rfile:
-            rows = rfile.readlines()
-            try:
-                # Write id, time, data to file.
-                id_ = str(int(rows[-1].split(',')[0]) + 1)
-                with open(fileName, 'a') as wfile:
-                    varList = [str(var) for var in varList]
-                    row = '\n' + str(id_) + ',' + parsedTime + ',' + str(','.join(varList))
-                    wfile.write(row)
-                    rowsAdded.append(row)
-                    
-                    if verbose:
-                        print('Added new row to data: \t', row[1:]) 
-
-            # Possibility: id can't be determined from file. Abort.
-            except ValueError:
-                print('''
-                The last line of "%s" doesn't start with a valid id value (int).
-                Something is wrong with your data file.
-                No data has been written to the file.''' % fileName)
-
-# Calls appendToCsv(). Values in d (nested dict) per pool/token become veriables per row in csv
-def updateCSV(d, fileName, order=None, verbose=True, logfile=None):
+
+        # Possibility: id can't be determined from file. Abort.
+        if lastId is None:
+            print('''
+            The last line of "%s" doesn't start with a valid id value (int).
+            Something is wrong with your data file.
+            No data has been written to the file.''' % fileName)
+            return rowsAdded
+        text, nextId = '', lastId + 1
+
+    # Write id, time, data of all rows to file at once.
+    for varList in rows:
+        row = '\n' + str(nextId) + ',' + parsedTime + ',' + ','.join([str(var) for var in varList])
+        rowsAdded.append(row)
+        nextId += 1
+    text += ''.join(rowsAdded)
+
+    with open(path, 'a') as wfile:
+        wfile.write(text)
+        wfile.flush()
+        os.fsync(wfile.fileno())
+
+    # Remember header width and last id for the next append
+    stat = os.stat(path)
+    _csvState[path] = {'nHeader': len(varNames) + 2, 'lastId': nextId - 1,
+                       'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+    if verbose:
+        for row in rowsAdded:
+            print('Added new row to data: \t', row[1:])
+
+    return rowsAdded
+
+# Appends a new row to csv as specified in fileName
+def appendToCsv(fileName, varList, varNames, verbose=True):
+    '''
+    Appends each value in varList as a new row to a file as specified in fileName.
+    Creates new file with header if not found in working dir.
+    Aborts with error message if it would change shape[1] of csv (= number of vars per row).
+    
+    Format of header:    id,time,[varNames]
+    Example for row:     0,2021 Feb 18 16:24,0.03,72,NaN,Yes,...
+    
+    1st value: Successive id (=first value in last row of file + 1).
+    2nd value: The current time in format "2021 Feb 18 17:34"
+    If there is no file yet: Creates file with header = id, timestamp, [varNames]
+    '''
+    
+    # Get name of function for error messages (depends on inspect, sys)
+    funcName = inspect.currentframe().f_code.co_name
+    
+    # Abort if number of variables and names don't add up.
+    assert len(varList) == len(varNames), \
+        f"{funcName}(): The number of variables and names to append to csv must be the same."
+
+    appendRows(fileName, [varList], varNames, verbose=verbose)
+
+# Calls appendRows(). Values in d (nested dict) per pool/token become veriables per row in csv
+def updateCSV(d, fileName, order=None, verbose=True, logfile=None, store=None):
     '''
     Appends current pool data from nested dict to csv file to keep track of
-    asset ratios over time.
+    asset ratios over time. All rows of one update are written at once.
     Order can be specified as list of variable names.
     logfile: If a textfile is specified, appends datetime & #rows to logfile.
+    store: If a HistoryStore is given, rows go there instead of the csv (fileName is ignored).
+    d may also be a RecordTable (i.e. from getPoolStatus(poolTable)), which is written
+    straight from its column arrays.
     '''
-    outDf = pd.DataFrame(d)
+    # Possibility: Table. Rows come straight from its columns.
+    if isinstance(d, RecordTable):
+        varNames = ['token'] + list(order or d.columns)
+        rows = d.rows(varNames[1:])
 
-    # Possibility: Reorder data as specified in order
-    if order:
-        outDf = outDf.reindex(order)
-        
-    # Count rows before appending data
-    if os.path.isfile(fileName):
-        with open(fileName, 'r') as file:
-            rowsBefore = len(file.readlines())
+    # Possibility: Nested dict. Collect one row per pair (all pairs share the same variable names)
     else:
-        rowsBefore = 0
-    
+        import pandas as pd
+        outDf = pd.DataFrame(d)
+
+        # Possibility: Reorder data as specified in order
+        if order:
+            outDf = outDf.reindex(order)
+
+        varNames = ['token'] + outDf.index.tolist()
+        rows = []
+        for pair in outDf:
+            varList = outDf[pair].values.tolist()
+            varList.insert(0, pair)
+            rows.append(varList)
+
+    # Possibility: store given. Append data to the history database instead.
+    if store:
+        difference = store.append(rows, varNames)
+        if verbose:
+            print(f'Appended {difference} rows to {store.path}.')
+        if logfile:
+            log(logfile, f'Appended {difference} rows to {store.path}.')
+        return
+
     # Append data
-    for pair in outDf:
-        name = pair
-        varNames = outDf[pair].index.tolist()
-        varNames.insert(0, 'token')
-        varList = outDf[pair].values.tolist()
-        varList.insert(0, name)
-        appendToCsv(fileName, varList, varNames, verbose=verbose)
-        
-    # Count rows after appending, prepare labeled sample row for printing
-    with open(fileName, 'r') as file:
-        lines = file.readlines()
-        rowsAfter = len(lines)
-        difference = rowsAfter - rowsBefore
-        headerList = lines[0].strip().split(',')
-        sampleRow = random.choice(lines[-difference:])
-        sampleList = sampleRow.strip().split(',')
-        
-    printDf = pd.DataFrame(sampleList, index=headerList, columns=['Sample Row'])
+    rowsAdded = appendRows(fileName, rows, varNames, verbose=verbose)
+    difference = len(rowsAdded)
+    if not difference:
+        return
+
+    # Prepare labeled sample row for printing
+    headerList = ['id', 'time'] + varNames
+    sampleList = random.choice(rowsAdded)[1:].split(',')
+    width = max(len(header) for header in headerList)
+    printRows = ['%-*s  %s' % (width, header, value) for header, value in zip(headerList, sampleList)]
     
     print(f'Appended {difference} rows to {fileName}.\nRandom sample:\n')
-    print(printDf)
+    print('\n'.join(printRows))
     
     # Option: Write summary to logfile
     if logfile:
         log(logfile, f'Appended {difference} rows to {fileName}.')
 
-# Appends a row (datetime + log message) to a logfile.
-def log(logfile, _str):
+# Indexed SQLite table of pool history with typed columns and epoch timestamps (alternative to the csv)
+class HistoryStore:
+    '''
+    Stores the rows updateCSV() would append to a csv in table {table} of the SQLite file {path}.
+    Columns: id, time (int, seconds since epoch), token, and one column per variable
+    (REAL for numbers, TEXT otherwise). Columns for new variables are added on the fly.
+    An index on (token, time) lets query() read only the rows of one pair and time range.
+    '''
+    def __init__(self, path, table='history'):
+        self.path = path
+        self.table = table
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            f'CREATE TABLE IF NOT EXISTS {_quote(table)} '
+            '(id INTEGER PRIMARY KEY, time INTEGER NOT NULL, token TEXT)'
+            )
+        self.conn.execute(
+            f'CREATE INDEX IF NOT EXISTS {_quote(table + "_token_time")} '
+            f'ON {_quote(table)} (token, time)'
+            )
+        self.conn.commit()
+
+    def columns(self):
+        '''
+        Returns list of column names of the history table.
+        '''
+        return [row[1] for row in self.conn.execute(f'PRAGMA table_info({_quote(self.table)})')]
+
+    @timedStage('historyStoreAppend')
+    def append(self, rows, varNames, timestamp=None, ids=None):
+        '''
+        Assumes list of rows (lists of values) and their varNames, the first of which is 'token'.
+        Inserts all rows in one transaction. Returns number of rows added.
+        timestamp: Epoch seconds for all rows (default: now) or list with one value per row.
+        ids:       List of ids, one per row (default: successive ids).
+        '''
+        if not rows:
+            return 0
+        if timestamp is None:
+            timestamp = int(datetime.now().timestamp())
+        if np.ndim(timestamp) == 0:
+            timestamp = [timestamp] * len(rows)
+
+        # Add columns for variables not seen before (type from the first row)
+        existing = set(self.columns())
+        for name, value in zip(varNames, rows[0]):
+            if name not in existing:
+                colType = 'REAL' if isinstance(value, (int, float, np.number)) else 'TEXT'
+                self.conn.execute(f'ALTER TABLE {_quote(self.table)} ADD COLUMN {_quote(name)} {colType}')
+
+        names = ['time'] + list(varNames)
+        values = ([int(t)] + [v.item() if isinstance(v, np.generic) else v for v in row]
+                  for t, row in zip(timestamp, rows))
+        if ids is not None:
+            names.insert(0, 'id')
+            values = ([int(i)] + row for i, row in zip(ids, values))
+
+        cols = ', '.join(_quote(name) for name in names)
+        marks = ', '.join('?' * len(names))
+        with self.conn:
+            self.conn.executemany(f'INSERT INTO {_quote(self.table)} ({cols}) VALUES ({marks})', values)
+        return len(rows)
+
+    def query(self, token=None, start=None, end=None, columns=None):
+        '''
+        Returns DataFrame of stored rows, sorted by time.
+        token:      Only rows of this pair/token.
+        start, end: Only rows with start <= time < end (datetime or epoch seconds).
+        columns:    List of variables to load (id, time and token are always included).
+        '''
+        import pandas as pd
+        where, params = [], []
+        if token is not None:
+            where.append('token = ?')
+            params.append(token)
+        if start is not None:
+            where.append('time >= ?')
+            params.append(_toEpoch(start))
+        if end is not None:
+            where.append('time < ?')
+            params.append(_toEpoch(end))
+
+        cols = ['id', 'time', 'token'] + [col for col in (columns or []) if col not in {'id', 'time', 'token'}]
+        sql = 'SELECT %s FROM %s' % (', '.join(_quote(col) for col in cols) if columns else '*', _quote(self.table))
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY time, id'
+
+        return pd.read_sql_query(sql, self.conn, params=params)
+
+    def isEmpty(self):
+        '''
+        Returns True if the history table has no rows.
+        '''
+        return self.conn.execute(f'SELECT 1 FROM {_quote(self.table)} LIMIT 1').fetchone() is None
+
+    def close(self):
+        self.conn.close()
+
+# Helper function: Returns identifier quoted for SQLite (variable names like '24hVol' need it)
+def _quote(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+# Helper function: Returns epoch seconds of a datetime (or number)
+def _toEpoch(t):
+    if isinstance(t, datetime):
+        return int(t.timestamp())
+    return int(t)
+
+# Copies all rows of a csv written by appendToCsv()/updateCSV() into a HistoryStore
+def migrateCsv(fileName, store, chunksize=100000, verbose=True):
+    '''
+    Assumes a csv with header id,time,[varNames] (time in format "2021 Feb 18 17:34")
+    and a HistoryStore. Reads the csv in chunks and appends every row with its time
+    (converted to epoch seconds). Returns number of rows migrated.
+    The original ids are kept if the store is empty. Otherwise they'd collide with the
+    stored ones, so the rows get successive ids after the last stored one.
+    '''
+    import pandas as pd
+    keepIds = store.isEmpty()
+    migrated = 0
+    for chunk in pd.read_csv(fileName, chunksize=chunksize):
+        # Convert each distinct (local) time once, like datetime.now().timestamp() in append()
+        epochs = {t: int(datetime.strptime(t, '%Y %b %d %H:%M').timestamp()) for t in chunk['time'].unique()}
+        epochs = chunk['time'].map(epochs)
+        varNames = [col for col in chunk.columns if col not in {'id', 'time'}]
+        store.append(chunk[varNames].values.tolist(), varNames, timestamp=epochs.tolist(),
+                     ids=chunk['id'].tolist() if keepIds else None)
+        migrated += len(chunk)
+
+    if verbose:
+        print(f'Migrated {migrated} rows from {fileName} to {store.path}.')
+    return migrated
+
+# Background writer for log(): Collects rows in a queue and appends them to their files in batches
+class _LogWriter:
+    '''
+    log() only puts (logfile, row) into the queue, so it never waits for the disk.
+    A daemon thread writes everything queued so far with one open/write per file,
+    at the latest every {interval} seconds. flush() blocks until all rows are written.
+    '''
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.queue = queue.Queue()
+        self.thread = None
+        self._lock = threading.Lock()
+
+    def put(self, logfile, row):
+        if self.thread is None:
+            with self._lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._run, name='logWriter', daemon=True)
+                    self.thread.start()
+        self.queue.put((logfile, row))
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self.queue.get(timeout=self.interval)]
+            except queue.Empty:
+                continue
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write(batch)
+            for _ in batch:
+                self.queue.task_done()
+
+    def _write(self, batch):
+        rowsPerFile = {}
+        for logfile, row in batch:
+            rowsPerFile.setdefault(logfile, []).append(row)
+        for logfile, rows in rowsPerFile.items():
+            try:
+                with open(logfile, 'a') as file:
+                    file.write(''.join(rows))
+            except OSError as e:
+                print(f"log(): Couldn't write to {logfile}: {e!r}", file=sys.stderr)
+
+    def flush(self):
+        if self.thread is not None:
+            self.queue.join()
+
+_logWriter = _LogWriter()
+atexit.register(_logWriter.flush)
+
+# Appends a row (datetime + log message) to a logfile (written in the background, see flushLogs())
+def log(logfile, _str, **fields):
     '''
     Appends current date, time, and _str as row to logfile (i.e. logging.txt).
+    fields: Optional structured data, appended to the row as json (i.e. log(f, 'tick', seconds=0.2)).
+    Returns right away, rows are written in batches by a background thread.
     '''
     # Get current time.
     timestamp = datetime.now()
     parsedTime = timestamp.strftime('%Y %b %d %H:%M')
     
     row = '\n' + parsedTime + '\t' + _str
+    if fields:
+        row += '\t' + json.dumps(fields, default=str)
     
-    with open(logfile, 'a') as file:
-        file.write(row)
+    _logWriter.put(logfile, row)
+
+# Blocks until all rows passed to log() are written (also runs at exit)
+def flushLogs():
+    _logWriter.flush()
+
+# Metrics per coin scraped from coingecko's listing table (see metricsFromRow())
+MARKET_VARS = ['rank', 'priceUSD', 'priceBTC', 'percChange1h', 'percChange24h', 'percChange7d',
+               'vol24h', 'mcUSD', 'mcBTC']
 
 # Helper function to scrape all metrics from a row out of the top 100 table on Coingecko.com
-def metricsFromRow(row, BTCprice, logfile=None):
+def metricsFromRow(row, BTCprice=None, logfile=None, verbose=False):
     '''
     Gets a row from the live coin table of coingecko.com.
     Returns dict {symbol: {metrics}} for this row / this coin.
+    BTCprice: If None, 'priceBTC' and 'mcBTC' are left out (see iterMarketRows()).
+    Returns {symbol: {}} if the row couldn't be scraped completely.
     '''
     funcName = inspect.currentframe().f_code.co_name
     row = list(row)
     tokenDict = {}
     
     valDict = {}
+    symbol = None
     
     # Try to scrape metrics from row in table
     try:
         symbol = list(row[5])[1].get_text().split('\n')[-4]
         valDict['rank'] = int(clean(row[3].get_text()))
         valDict['priceUSD'] = clean(row[7].get_text())
-        valDict['priceBTC'] = priceUSD / BTCprice
         valDict['percChange1h'] = clean(row[9].get_text())
         valDict['percChange24h'] = clean(row[11].get_text())
         valDict['percChange7d'] = clean(row[13].get_text())
         valDict['vol24h'] = clean(row[15].get_text())
         valDict['mcUSD'] = clean(row[17].get_text())
-        valDict['mcBTC'] = mcUSD / BTCprice
+        if BTCprice:
+            valDict['priceBTC'] = valDict['priceUSD'] / BTCprice
+            valDict['mcBTC'] = valDict['mcUSD'] / BTCprice
         
-    # Possibility: Metric can't be scraped from website
-    except IndexError:
+    # Possibility: Metric can't be scraped from website (or isn't a number, i.e. '?')
+    except (IndexError, ValueError):
         message = f"{funcName}(): Couldn't scrape all metrics for {symbol}. Maybe the website changed?"
         print(message)
+        valDict = {}
         
         # Option: Write to logfile
         if logfile:
             log(logfile, message)
     
     tokenDict[symbol] = valDict
-    print(tokenDict)
+    if verbose:
+        print(tokenDict)
     
     return tokenDict
 
-# TODO: Saves a daily snapshot of all top 100 cryptos from coingecko and stores it in dailyTop100.csv
+# Helper function: Downloads one page of coingecko's listing table and returns its rows (without header)
+def _fetchMarketPage(page, rateLimiter, timeout, retries, extractor):
+    html = fetchPage(f'{BASE_URL}?page={page}', timeout=timeout, retries=retries, rateLimiter=rateLimiter)
+    return extractTags(html, {'rows': ('tr', None)}, extractor=extractor)['rows'][1:]
+
+# Generator: Yields (symbol, metrics) for every coin on the first {pages} pages of coingecko's listing
+def iterMarketRows(pages=10, workers=4, rateLimit=1.0, burst=1, timeout=10, retries=3,
+                   logfile=None, extractor=None):
+    '''
+    Downloads listing pages (100 coins each) concurrently, spaced out by a shared RateLimiter
+    ({rateLimit} requests per second, bursts of {burst}). At most 2 * {workers} pages are
+    downloaded ahead of the consumer, so memory doesn't grow with {pages}.
+    Yields (symbol, valDict) in rank order. valDict has all MARKET_VARS except the
+    BTC-denominated ones, see marketSnapshot(). Rows that can't be scraped are skipped.
+    '''
+    rateLimiter = RateLimiter(rateLimit, burst)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = []
+        nextPage = 1
+
+        # Keep a window of pages in flight, yield them in order
+        while pending or nextPage <= pages:
+            while nextPage <= pages and len(pending) < 2 * workers:
+                pending.append(executor.submit(_fetchMarketPage, nextPage, rateLimiter, timeout,
+                                               retries, extractor))
+                nextPage += 1
+
+            for row in pending.pop(0).result():
+                symbol, valDict = list(metricsFromRow(row, logfile=logfile).items())[0]
+                if valDict:
+                    yield symbol, valDict
+
+# Adds 'priceBTC' and 'mcBTC' to column arrays of a snapshot batch (one vectorized pass)
+def addBtcColumns(columns, BTCprice):
+    '''
+    Assumes dict of equally long arrays containing 'priceUSD' and 'mcUSD' and the BTC price (USD).
+    Returns the same dict with 'priceBTC' and 'mcBTC' added.
+    '''
+    columns['priceBTC'] = np.asarray(columns['priceUSD'], dtype=float) / BTCprice
+    columns['mcBTC'] = np.asarray(columns['mcUSD'], dtype=float) / BTCprice
+    return columns
+
+# Saves a snapshot of the top {pages * 100} cryptos from coingecko to a HistoryStore or csv
+def marketSnapshot(pages=10, store=None, fileName=None, batchSize=1000, verbose=True, logfile=None,
+                   **kwargs):
+    '''
+    Streams rows from iterMarketRows() (kwargs are passed on) into the store (HistoryStore)
+    or else the csv fileName, in batches of {batchSize} coins with the same timestamp.
+    Columns: token (= symbol), MARKET_VARS.
+    The BTC price is taken from the BTC row (always on page 1), so the BTC-denominated
+    metrics of each batch are computed with one array division before writing.
+    Returns number of coins saved.
+    '''
+    # Get name of function for error messages (depends on inspect, sys)
+    funcName = inspect.currentframe().f_code.co_name
+    assert store or fileName, f'{funcName}(): Specify a HistoryStore (store) or a csv (fileName).'
+
+    varNames = ['token'] + MARKET_VARS
+    timestamp = datetime.now()
+    BTCprice = None
+    saved = 0
+
+    # Helper function: Writes one batch of (symbol, valDict) with BTC columns added
+    def flush(batch):
+        columns = {var: [valDict.get(var) for _, valDict in batch] for var in MARKET_VARS}
+        columns = addBtcColumns(columns, BTCprice)
+        symbols = [symbol for symbol, _ in batch]
+        rows = [list(row) for row in zip(symbols, *(columns[var] for var in MARKET_VARS))]
+        if store:
+            store.append(rows, varNames, timestamp=int(timestamp.timestamp()))
+        else:
+            appendRows(fileName, rows, varNames, verbose=False)
+        return len(rows)
+
+    batch = []
+    for symbol, valDict in iterMarketRows(pages=pages, logfile=logfile, **kwargs):
+        if symbol == 'BTC' and BTCprice is None:
+            BTCprice = valDict['priceUSD']
+        batch.append((symbol, valDict))
+        if len(batch) >= batchSize and BTCprice:
+            saved += flush(batch)
+            batch = []
+
+    assert BTCprice, f"{funcName}(): BTC wasn't found in the listing, can't compute BTC-denominated metrics."
+    if batch:
+        saved += flush(batch)
+
+    message = f'{funcName}(): Saved {saved} coins to {store.path if store else fileName}.'
+    if verbose:
+        print(message)
+    if logfile:
+        log(logfile, message)
+    return saved
+
+# Scrapes the top 100 cryptos from coingecko (first page of marketSnapshot())
 # Metrics: symbol, rank, priceUSD, priceBTC, mcUSD, mcBTC, 24hPercentChange, 7dPercentChange, 24hVol
-def dailyTop100Snapshot(logfile=None):
+def dailyTop100Snapshot(logfile=None, extractor=None):
     '''
     Visits Coingecko's main page and scrapes the table data (top 100 coins).
     Returns a nested dict of shape {'symbol': {'metric1': val, 'metric2': val, ...}}
     where the keys are the coin symbols, i.e. 'BTC', 'ETH'.
+    extractor: Name of a backend in EXTRACTORS. Defaults to EXTRACTOR.
+    For more coins and to save them, use marketSnapshot().
     '''
-    top100Dict = {}
-    
-    # Scrape coingecko main page and parse to bs object
-    url = 'https://www.coingecko.com/en'
-    userAgent = 'Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko)' + \
-        ' Chrome/41.0.2228.0 Safari/537.36'
-    req = urllib.request.Request(url, headers= {'User-Agent' : userAgent})
-    html = urllib.request.urlopen(req)
-    bs = BeautifulSoup(html.read(), 'html.parser')
-    
-    # Get all table rows from website except for header row
-    tableRows = bs.findAll('tr')[1:]
-    
+    top100Dict = dict(iterMarketRows(pages=1, workers=1, logfile=logfile, extractor=extractor))
+
     # Get BTC price to calculate BTC-denominated metrics
-    BTCprice = clean(list(tableRows[0])[7].get_text())
-    
-    # For every row (= coin) in table: Get metrics and append to top100Dict
-    for row in tableRows:
-        tokenDict = metricsFromRow(row, BTCprice, logfile=logfile)
-        top100Dict.update(tokenDict)
-#    symbol = list(tokenDict)[0]
-#    top100Dict[symbol] = tokenDict[symbol]
+    BTCprice = top100Dict['BTC']['priceUSD']
+    for valDict in top100Dict.values():
+        valDict['priceBTC'] = valDict['priceUSD'] / BTCprice
+        valDict['mcBTC'] = valDict['mcUSD'] / BTCprice
         
     return top100Dict
 
+# Helper function: Extracts the metrics of a batch of archived pages (runs in a worker process)
+def _reextractBatch(args):
+    root, kind, entries, extractor = args
+    results, failed = [], []
+    for fetchedAt, key, digest in entries:
+        try:
+            html = _readArchived(root, digest)
+            if kind == 'token':
+                results.append((fetchedAt, key, extractTokenMetrics(html, key, extractor=extractor)))
+            else:
+                rows = extractTags(html, {'rows': ('tr', None)}, extractor=extractor)['rows'][1:]
+                for row in rows:
+                    symbol, valDict = list(metricsFromRow(row).items())[0]
+                    if valDict:
+                        results.append((fetchedAt, symbol, valDict))
+
+        # Possibility: Page can't be parsed (i.e. an error page was archived). Report, go on.
+        except Exception as e:
+            failed.append((fetchedAt, key, repr(e)))
+    return results, failed
+
+# Generator: Yields (fetchedAt, key, metrics) for all archived pages of one kind, extracted on a process pool
+def iterReextracted(archive, kind='token', workers=None, batchSize=50, start=None, end=None,
+                    extractor=None, logfile=None):
+    '''
+    Assumes a PageArchive. Re-runs extraction over its pages without touching the network:
+    kind 'token':   extractTokenMetrics(), yields (fetchedAt, tokenStr, tokenDict).
+    kind 'listing': metricsFromRow() on every row, yields (fetchedAt, symbol, valDict)
+                    (without the BTC-denominated metrics, see addBtcColumns()).
+    Pages are parsed in batches of {batchSize} on a pool of {workers} processes (default:
+    all cores), at most 2 batches per worker ahead of the consumer. Results come in fetch order.
+    start, end: See PageArchive.entries(). Pages that can't be parsed are reported and skipped.
+    '''
+    # Get name of function for error messages (depends on inspect, sys)
+    funcName = inspect.currentframe().f_code.co_name
+    assert kind in {'token', 'listing'}, f"{funcName}(): kind must be 'token' or 'listing'."
+
+    entries = [(fetchedAt, key, digest) for fetchedAt, _, _, key, digest in archive.entries(kind, start, end)]
+    batches = [entries[i:i + batchSize] for i in range(0, len(entries), batchSize)]
+    tasks = ((archive.root, kind, batch, extractor) for batch in batches)
+
+    # Possibility: One worker. Don't start processes.
+    if workers == 1:
+        resultSets = map(_reextractBatch, tasks)
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        resultSets = _orderedWindow(executor, _reextractBatch, tasks, 2 * (workers or os.cpu_count() or 1))
+
+    try:
+        for results, failed in resultSets:
+            for fetchedAt, key, error in failed:
+                message = f"{funcName}(): Couldn't parse '{key}' fetched at {datetime.fromtimestamp(fetchedAt)}: {error}"
+                print(message)
+                if logfile:
+                    log(logfile, message)
+            yield from results
+    finally:
+        if workers != 1:
+            executor.shutdown(cancel_futures=True)
+
+# Helper function: Maps func over tasks on an executor, with at most {window} tasks in flight, in order
+def _orderedWindow(executor, func, tasks, window):
+    pending = []
+    for task in tasks:
+        pending.append(executor.submit(func, task))
+        if len(pending) >= window:
+            yield pending.pop(0).result()
+    while pending:
+        yield pending.pop(0).result()
+
+# Re-extracts all archived pages of one kind and saves the metrics with their original fetch time
+def reextractArchive(archive, store, kind='token', batchSize=1000, verbose=True, logfile=None, **kwargs):
+    '''
+    Streams results of iterReextracted() (kwargs are passed on) into the store (HistoryStore),
+    {batchSize} rows per transaction. Columns: token (tokenStr or symbol) and the extracted
+    metrics, time is the time the page was fetched. Returns number of rows saved.
+    '''
+    # Get name of function for error messages (depends on inspect, sys)
+    funcName = inspect.currentframe().f_code.co_name
+
+    varNames = None
+    rows, times = [], []
+    saved = 0
+
+    for fetchedAt, key, valDict in iterReextracted(archive, kind=kind, logfile=logfile, **kwargs):
+        if varNames is None:
+            varNames = ['token'] + list(valDict)
+        rows.append([key] + [valDict.get(var) for var in varNames[1:]])
+        times.append(fetchedAt)
+        if len(rows) >= batchSize:
+            saved += store.append(rows, varNames, timestamp=times)
+            rows, times = [], []
+    saved += store.append(rows, varNames, timestamp=times)
+
+    message = f'{funcName}(): Saved {saved} rows from {archive.root} to {store.path}.'
+    if verbose:
+        print(message)
+    if logfile:
+        log(logfile, message)
+    return saved
+
+# Helper function: Returns nested dict from a json file
+def _loadJson(fileName):
+    with open(fileName, 'r') as file:
+        return json.load(file)
+
+# Helper function: Prints a RecordTable as aligned text (without pandas)
+def _printTable(table, keyName='pair'):
+    varNames = list(table.columns)
+    rows = [[str(v) for v in row] for row in table.rows(varNames)]
+    widths = [max(len(x) for x in col) for col in zip([keyName] + varNames, *rows)]
+    for row in [[keyName] + varNames] + rows:
+        print('  '.join(x.rjust(w) if i else x.ljust(w) for i, (x, w) in enumerate(zip(row, widths))))
+
+# Command line interface: python liqudityPoolTool.py {status, scrape, snapshot, plot, daemon, reextract} ...
+def main(argv=None):
+    '''
+    Entry point of the command line interface. Run with -h for help.
+    Heavy modules (pandas, matplotlib, bs4) are only imported by the commands that need them.
+    Pools are read from a json file of token pairs:
+    {pair: {'colStr': 'ethereum', 'assStr': 'dai', 'numColEntry': 1.0, 'numAssEntry': 2000.0}, ...}
+    '''
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Estimate current asset ratios and value of liquidity pools.')
+    parser.add_argument('--metrics', help='collect stage timings and counters (METRICS), write them to this '
+                                          'file at exit (.prom / .txt: Prometheus text format, else json)')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    def addOutput(command):
+        command.add_argument('--csv', help='append results to this csv file')
+        command.add_argument('--db', help='append results to this SQLite file (HistoryStore) instead')
+        command.add_argument('--logfile', help='append log messages to this text file')
+        command.add_argument('--archive', help='keep all downloaded pages in this directory (PageArchive)')
+
+    status = commands.add_parser('status', help='price all pools and print their value and token amounts')
+    status.add_argument('pools', help='json file of token pairs')
+    status.add_argument('--prices', help='json file {token: priceUSD} to use instead of coingecko')
+    status.add_argument('--round', type=int, default=2, help='decimals (default: 2)')
+    addOutput(status)
+
+    scrape = commands.add_parser('scrape', help='scrape coingecko metrics of all tokens in the pools')
+    scrape.add_argument('pools', help='json file of token pairs')
+    scrape.add_argument('--workers', type=int, default=4, help='concurrent downloads (default: 4)')
+    scrape.add_argument('--rate', type=float, default=1.0, help='requests per second (default: 1)')
+    addOutput(scrape)
+
+    snapshot = commands.add_parser('snapshot', help='save metrics of the top coins on coingecko')
+    snapshot.add_argument('--pages', type=int, default=10, help='listing pages of 100 coins (default: 10)')
+    snapshot.add_argument('--workers', type=int, default=4, help='concurrent downloads (default: 4)')
+    snapshot.add_argument('--rate', type=float, default=1.0, help='requests per second (default: 1)')
+    addOutput(snapshot)
+
+    plot = commands.add_parser('plot', help='line plot of two columns of a csv file')
+    plot.add_argument('file', help='csv file, i.e. written by status --csv')
+    plot.add_argument('x', help='column on the x axis')
+    plot.add_argument('y', help='column on the y axis')
+    plot.add_argument('--out', help='render to this .png / .svg file instead of showing the plot')
+    plot.add_argument('--points', type=int, help='downsample to about this many points (LTTB)')
+
+    daemon = commands.add_parser('daemon', help='poll prices and save pools whenever their prices change')
+    daemon.add_argument('pools', help='json file of token pairs')
+    daemon.add_argument('--interval', type=float, default=60, help='seconds between price polls (default: 60)')
+    daemon.add_argument('--ticks', type=int, help='stop after this many ticks (default: run until Ctrl+C)')
+    addOutput(daemon)
+
+    reextract = commands.add_parser('reextract', help='parse all pages in an archive again (no network)')
+    reextract.add_argument('archive', help='directory of a PageArchive, i.e. written with --archive')
+    reextract.add_argument('db', help='SQLite file (HistoryStore) to append the metrics to')
+    reextract.add_argument('--kind', choices=['token', 'listing'], default='token',
+                           help='pages to parse (default: token)')
+    reextract.add_argument('--workers', type=int, help='parser processes (default: all cores)')
+    reextract.add_argument('--logfile', help='append log messages to this text file')
+
+    args = parser.parse_args(argv)
+    store = HistoryStore(args.db) if getattr(args, 'db', None) else None
+
+    # Option: Keep every downloaded page
+    global PAGE_ARCHIVE
+    if getattr(args, 'archive', None) and args.command != 'reextract':
+        PAGE_ARCHIVE = PageArchive(args.archive)
+
+    # Option: Collect metrics of all stages, written at exit (also if the command fails)
+    if args.metrics:
+        METRICS.enabled = True
+
+    try:
+        if args.command == 'status':
+            table = PoolTable.fromDict(_loadJson(args.pools))
+            provider = StaticPriceProvider(_loadJson(args.prices)) if args.prices else BulkPriceProvider()
+            result = getPoolStatus(addPrices(table, provider), roundTo=args.round)
+            _printTable(result)
+            if args.csv or store:
+                updateCSV(result, args.csv, verbose=False, logfile=args.logfile, store=store)
+
+        elif args.command == 'scrape':
+            metrics = createMetricsDict(_loadJson(args.pools), workers=args.workers, rateLimit=args.rate,
+                                        logfile=args.logfile, asTable=True)
+            _printTable(metrics, keyName='token')
+            if args.csv or store:
+                updateCSV(metrics, args.csv, verbose=False, logfile=args.logfile, store=store)
+
+        elif args.command == 'snapshot':
+            assert args.csv or store, 'snapshot: Specify --csv or --db.'
+            marketSnapshot(pages=args.pages, store=store, fileName=args.csv, workers=args.workers,
+                           rateLimit=args.rate, logfile=args.logfile)
+
+        elif args.command == 'plot':
+            import pandas as pd
+            plot_line(pd.read_csv(args.file, usecols=[args.x, args.y]), args.x, args.y, fileName=args.out,
+                      maxPoints=args.points)
+
+        elif args.command == 'daemon':
+            poolDaemon = PoolDaemon(_loadJson(args.pools), interval=args.interval, fileName=args.csv,
+                                    store=store, verbose=True, logfile=args.logfile,
+                                    metricsFile=args.metrics)
+            print(poolDaemon.run(maxTicks=args.ticks))
+
+        elif args.command == 'reextract':
+            archive = PageArchive(args.archive)
+            reextractArchive(archive, store, kind=args.kind, workers=args.workers, logfile=args.logfile)
+            archive.close()
+
+    finally:
+        if store:
+            store.close()
+        if PAGE_ARCHIVE is not None:
+            PAGE_ARCHIVE.close()
+            PAGE_ARCHIVE = None
+
+        if args.metrics:
+            METRICS.write(args.metrics)
 
+if __name__ == '__main__':
+    main()
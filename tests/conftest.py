@@ -0,0 +1,4 @@
+import os, sys
+
+# Make liqudityPoolTool (in the repo root) importable from the tests
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,107 @@
+# TokenCache: ttl, revalidation with ETag (304) against a local server, eviction
+import http.server
+import os
+import threading
+import pytest
+
+import liqudityPoolTool as lpt
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+@pytest.fixture
+def server(monkeypatch):
+    '''
+    Local stand-in for coingecko serving the ethereum fixture for every token, with ETag "v1".
+    Yields a dict counting requests: {'full': 200 answers, 'notModified': 304 answers}.
+    '''
+    with open(os.path.join(FIXTURES, 'token_ethereum.html'), 'rb') as file:
+        body = file.read()
+    counts = {'full': 0, 'notModified': 0}
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            if self.headers.get('If-None-Match') == '"v1"':
+                counts['notModified'] += 1
+                self.send_response(304)
+                self.send_header('ETag', '"v1"')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            counts['full'] += 1
+            self.send_response(200)
+            self.send_header('ETag', '"v1"')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    monkeypatch.setattr(lpt, 'BASE_URL', f'http://127.0.0.1:{httpd.server_address[1]}/en')
+    yield counts
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def scrape(tokenStr, cache):
+    return lpt.getTokenMetrics(tokenStr, cache=cache, rateLimiter=lpt.RateLimiter(1000, 100))
+
+
+def test_fresh_entries_are_served_without_request(server):
+    cache = lpt.TokenCache(ttl=60)
+    first = scrape('ethereum', cache)
+    assert scrape('ethereum', cache) == first
+    assert server == {'full': 1, 'notModified': 0}
+    assert cache.stats()['hits'] == 1
+
+
+def test_stale_entries_are_revalidated(server, monkeypatch):
+    cache = lpt.TokenCache(ttl=60)
+    first = scrape('ethereum', cache)
+
+    # Entry expires after ttl seconds: conditional request, 304, cached value
+    now = lpt.time()
+    monkeypatch.setattr(lpt, 'time', lambda: now + 61)
+    assert scrape('ethereum', cache) == first
+    assert server == {'full': 1, 'notModified': 1}
+    assert cache.stats()['revalidated'] == 1
+
+    # Revalidated entry is fresh again
+    assert scrape('ethereum', cache) == first
+    assert server['notModified'] == 1
+
+
+def test_least_recently_used_entries_are_evicted(server):
+    cache = lpt.TokenCache(ttl=60, maxSize=2)
+    for tokenStr in ['a', 'b', 'a', 'c']:
+        scrape(tokenStr, cache)
+    assert cache.getFresh('a') is not None
+    assert cache.getFresh('b') is None
+    assert cache.stats()['size'] == 2
+
+
+def test_evicted_entry_during_revalidation_is_fetched_again(server):
+    cache = lpt.TokenCache(ttl=0)
+    scrape('ethereum', cache)
+
+    # Entry is dropped between validators() and the 304 answer
+    validators = cache.validators
+    def evictingValidators(key):
+        headers = validators(key)
+        cache.clear()
+        return headers
+    cache.validators = evictingValidators
+
+    assert scrape('ethereum', cache)['symbol'] == 'ETH'
+    assert server == {'full': 2, 'notModified': 1}
+
+
+def test_entries_survive_restart_in_cache_dir(server, tmp_path):
+    scrape('ethereum', lpt.TokenCache(ttl=60, cacheDir=str(tmp_path)))
+    cache = lpt.TokenCache(ttl=60, cacheDir=str(tmp_path))
+    assert cache.getFresh('ethereum')['symbol'] == 'ETH'
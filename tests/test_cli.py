@@ -0,0 +1,46 @@
+# Command line interface: the status command has to stay light (see benchmarks.STATUS_IMPORT_BUDGET)
+import json
+import os
+
+import benchmarks
+import liqudityPoolTool as lpt
+
+POOLS = {'ETH-DAI': {'colStr': 'ethereum', 'assStr': 'dai', 'numColEntry': 1.0, 'numAssEntry': 2000.0}}
+PRICES = {'ethereum': 2000.0, 'dai': 1.0}
+
+
+def test_status_doesnt_import_heavy_modules_and_stays_in_budget():
+    # Median of 3 fresh interpreters, each running main(['status', ...]) on a small portfolio
+    result = benchmarks.measureStatusImports(runs=3)
+    assert result['heavy'] == []
+    assert result['seconds'] < benchmarks.STATUS_IMPORT_BUDGET, result
+
+
+def test_status_writes_csv(tmp_path, capsys):
+    pools, prices, csv = tmp_path / 'pools.json', tmp_path / 'prices.json', tmp_path / 'status.csv'
+    pools.write_text(json.dumps(POOLS))
+    prices.write_text(json.dumps(PRICES))
+
+    lpt.main(['status', str(pools), '--prices', str(prices), '--csv', str(csv)])
+    assert 'ETH-DAI' in capsys.readouterr().out
+    lines = csv.read_text().strip().splitlines()
+    assert lines[0].split(',')[:3] == ['id', 'time', 'token']
+    assert lines[1].split(',')[2] == 'ETH-DAI'
+
+
+def test_metrics_flag_writes_prometheus_file(tmp_path, capsys):
+    pools, prices, csv = tmp_path / 'pools.json', tmp_path / 'prices.json', tmp_path / 'status.csv'
+    pools.write_text(json.dumps(POOLS))
+    prices.write_text(json.dumps(PRICES))
+    metricsFile = tmp_path / 'metrics.prom'
+
+    try:
+        lpt.main(['--metrics', str(metricsFile), 'status', str(pools), '--prices', str(prices),
+                  '--csv', str(csv)])
+    finally:
+        lpt.METRICS.enabled = False
+        lpt.METRICS.reset()
+    text = metricsFile.read_text()
+    assert '# TYPE lpt_stage_calls_total counter' in text
+    assert 'lpt_stage_calls_total{stage="getPoolStatus"} 1' in text
+    assert 'lpt_stage_seconds_total{stage="appendToCsv"}' in text
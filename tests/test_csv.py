@@ -0,0 +1,43 @@
+# appendRows(): ids across appends and appends after the file was changed by someone else
+import pandas as pd
+import pytest
+
+import liqudityPoolTool as lpt
+
+
+def ids(fileName):
+    return pd.read_csv(fileName)['id'].tolist()
+
+
+def test_ids_continue_across_appends(tmp_path):
+    fileName = str(tmp_path / 'pools.csv')
+    lpt.appendRows(fileName, [[1, 2], [3, 4]], ['a', 'b'], verbose=False)
+    lpt.appendRows(fileName, [[5, 6]], ['a', 'b'], verbose=False)
+    lpt.appendRows(fileName, [[7, 8], [9, 10]], ['a', 'b'], verbose=False)
+    assert ids(fileName) == [0, 1, 2, 3, 4]
+    assert pd.read_csv(fileName)['a'].tolist() == [1, 3, 5, 7, 9]
+
+
+def test_rows_written_by_someone_else_are_noticed(tmp_path):
+    fileName = str(tmp_path / 'pools.csv')
+    lpt.appendRows(fileName, [[1, 2]], ['a', 'b'], verbose=False)
+    lpt.appendRows(fileName, [[3, 4]], ['a', 'b'], verbose=False)
+
+    # Another writer appends a row with a higher id: Size (and mtime) change
+    with open(fileName, 'a') as file:
+        file.write('\n41,2024 Jan 01 00:00,5,6')
+    lpt.appendRows(fileName, [[7, 8]], ['a', 'b'], verbose=False)
+    assert ids(fileName) == [0, 1, 41, 42]
+
+
+def test_changed_header_width_is_noticed(tmp_path):
+    fileName = str(tmp_path / 'pools.csv')
+    lpt.appendRows(fileName, [[1, 2]], ['a', 'b'], verbose=False)
+
+    # File is replaced by one with a different header
+    with open(fileName, 'w') as file:
+        file.write('id,time,a,b,c\n0,2024 Jan 01 00:00,1,2,3')
+    with pytest.raises(AssertionError):
+        lpt.appendRows(fileName, [[3, 4]], ['a', 'b'], verbose=False)
+    lpt.appendRows(fileName, [[3, 4, 5]], ['a', 'b', 'c'], verbose=False)
+    assert ids(fileName) == [0, 1]
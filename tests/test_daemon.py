@@ -0,0 +1,40 @@
+# PoolDaemon: polling, recomputing only changed pools
+import os
+
+import liqudityPoolTool as lpt
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+POOLS = {'ETH-DAI': {'colStr': 'ethereum', 'assStr': 'dai', 'numColEntry': 1.0, 'numAssEntry': 2000.0}}
+
+
+def test_default_provider_sees_new_prices_within_cache_ttl(monkeypatch):
+    with open(os.path.join(FIXTURES, 'token_ethereum.html'), 'r') as file:
+        html = file.read()
+    pagePrices = {'ethereum': '$2,060.15', 'dai': '$1.00'}
+
+    # Api doesn't know the tokens, pages show the current price in pagePrices
+    def fetchPage(url, returnResponse=False, **kwargs):
+        if '/simple/price' in url:
+            return b'{}'
+        tokenStr = url.rsplit('/', 1)[-1]
+        body = html.replace('>$2,060.15</span>', '>%s</span>' % pagePrices[tokenStr]).encode()
+        return (200, {}, body) if returnResponse else body
+
+    monkeypatch.setattr(lpt, 'fetchPage', fetchPage)
+    monkeypatch.setattr(lpt.random, 'random', lambda: 0.0)
+
+    daemon = lpt.PoolDaemon(POOLS, interval=1)
+    assert daemon.tick(now=0)['recomputed'] == 1
+    pagePrices['ethereum'] = '$2,500.00'
+    assert daemon.tick(now=1)['recomputed'] == 1
+    assert daemon.prices[daemon.tokens.index('ethereum')] == 2500.0
+
+
+def test_unchanged_prices_are_skipped():
+    daemon = lpt.PoolDaemon(POOLS, provider=lpt.StaticPriceProvider({'ethereum': 2000.0, 'dai': 1.0}), interval=1)
+    assert daemon.tick(now=0)['recomputed'] == 1
+    assert daemon.tick(now=1)['skipped'] == 1
+
+
+def test_run_without_pools_returns():
+    assert lpt.PoolDaemon({}).run(maxTicks=1)['ticks'] == 0
@@ -0,0 +1,60 @@
+# The stream extractor has to return exactly what the bs4 extractor returns (see extractTags())
+import os
+import pytest
+
+import liqudityPoolTool as lpt
+
+pytest.importorskip('bs4')
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def readFixture(name):
+    with open(os.path.join(FIXTURES, name), 'rb') as file:
+        return file.read()
+
+
+def test_token_page_metrics_are_identical():
+    html = readFixture('token_ethereum.html')
+    bs4Dict = lpt.extractTokenMetrics(html, 'ethereum', extractor='bs4')
+    streamDict = lpt.extractTokenMetrics(html, 'ethereum', extractor='stream')
+    assert streamDict == bs4Dict
+    assert streamDict['mcRank'] == 2
+    assert streamDict['symbol'] == 'ETH'
+
+
+def test_token_page_tags_are_identical():
+    html = readFixture('token_ethereum.html')
+    bs4Tags = lpt.extractTags(html, lpt.TOKEN_PAGE_TAGS, extractor='bs4')
+    streamTags = lpt.extractTags(html, lpt.TOKEN_PAGE_TAGS, extractor='stream')
+    for key in lpt.TOKEN_PAGE_TAGS:
+        assert [tag.get_text() for tag in streamTags[key]] == [tag.get_text() for tag in bs4Tags[key]]
+        # bs4 splits 'class' into a list, the scrapers only read the other attributes
+        attrs = lambda tags: [{k: v for k, v in tag.attrs.items() if k != 'class'} for tag in tags]
+        assert attrs(streamTags[key]) == attrs(bs4Tags[key])
+
+
+def test_listing_rows_are_identical():
+    html = readFixture('listing_page1.html')
+    results = {}
+    for extractor in ['bs4', 'stream']:
+        rows = lpt.extractTags(html, {'rows': ('tr', None)}, extractor=extractor)['rows'][1:]
+        results[extractor] = [lpt.metricsFromRow(row) for row in rows]
+    assert results['stream'] == results['bs4']
+    assert [list(d)[0] for d in results['stream']] == ['BTC', 'ETH', 'AT&T', 'SCR', 'USDT', 'EMP']
+
+
+@pytest.mark.parametrize('extractor', ['bs4', 'stream'])
+def test_nested_script_text_is_left_out(extractor):
+    html = '<table><tr><th>Market Cap Rank</th><td>#5<script>var a=1;</script></td></tr></table>'
+    rows = lpt.extractTags(html, {'rows': ('tr', None)}, extractor=extractor)['rows']
+    assert rows[0].get_text() == 'Market Cap Rank#5'
+    assert lpt.RowIndex(rows).cell('Rank') == 5
+
+
+@pytest.mark.parametrize('extractor', ['bs4', 'stream'])
+def test_end_tag_of_uncollected_ancestor_closes_collected_elements(extractor):
+    html = ('<table><tr><td><span class="no-wrap">$1</td><td><span>$2</span></td></tr></table>'
+            '<p>tail text</p><span class="no-wrap">$3</span></b>')
+    spans = lpt.extractTags(html, {'spans': ('span', 'no-wrap')}, extractor=extractor)['spans']
+    assert [span.get_text() for span in spans] == ['$1', '$3']
@@ -0,0 +1,50 @@
+# FeeAccumulator and its use in getPoolStatus() / PoolDaemon
+import numpy as np
+
+import liqudityPoolTool as lpt
+
+POOLS = {'ETH-DAI': {'colStr': 'ethereum', 'assStr': 'dai', 'numColEntry': 1.0, 'numAssEntry': 2000.0}}
+
+
+def test_fees_accrue_at_last_rate():
+    acc = lpt.FeeAccumulator(['ETH-DAI'], feeTier=0.003, poolShare=0.5, now=0)
+    acc.update(vol24h=[86400.0], now=0)
+    acc.update(now=100)
+    assert np.allclose(acc.feesFor(['ETH-DAI', 'other']), [86400.0 * 0.003 * 0.5 / 86400 * 100, 0.0])
+
+
+def test_fees_for_without_tracked_pairs():
+    acc = lpt.FeeAccumulator([], feeTier=0.003, poolShare=0.5, now=0)
+    assert acc.feesFor(['ETH-DAI']).tolist() == [0.0]
+    assert acc.feesFor([]).tolist() == []
+
+
+def test_daemon_updates_fees_every_tick():
+    acc = lpt.FeeAccumulator(['ETH-DAI'], feeTier=0.003, poolShare=1.0, now=lpt.time() - 1000)
+    daemon = lpt.PoolDaemon(POOLS, provider=lpt.StaticPriceProvider({'ethereum': 2000.0, 'dai': 1.0}),
+                            fees=acc, volumes=lambda pairs: [86400.0] * len(pairs))
+    daemon.tick(now=0)
+    assert acc.rate[0] == 0.003
+    assert daemon.poolStatus['ETH-DAI']['fees'] == 0.0
+
+    # First tick only sets the rate, the second one adds fees
+    acc.lastUpdate -= 100
+    daemon.tick(now=daemon.nextDue.min())
+    assert acc.accrued[0] >= 0.3
+
+
+def test_daemon_saves_fees_of_unchanged_pools(tmp_path):
+    acc = lpt.FeeAccumulator(['ETH-DAI'], feeTier=0.003, poolShare=1.0)
+    store = lpt.HistoryStore(str(tmp_path / 'history.db'))
+    daemon = lpt.PoolDaemon(POOLS, provider=lpt.StaticPriceProvider({'ethereum': 2000.0, 'dai': 1.0}),
+                            store=store, fees=acc, volumes=lambda pairs: [86400.0 * 1000] * len(pairs))
+    daemon.tick(now=0)
+
+    # Prices don't change, but the pool's fees do
+    acc.lastUpdate -= 100
+    assert daemon.tick(now=daemon.nextDue.min())['recomputed'] == 0
+    df = store.query('ETH-DAI')
+    assert df['fees'].tolist() == [0.0, round(acc.accrued[0], 2)]
+    assert df['poolValueInclFees'].tolist() == [df['poolValue'][0], round(df['poolValue'][0] + acc.accrued[0], 2)]
+    assert daemon.poolStatus['ETH-DAI']['fees'] == df['fees'][1]
+    store.close()
@@ -0,0 +1,32 @@
+# Scraping of coingecko's listing table (metricsFromRow(), iterMarketRows())
+import os
+import pytest
+
+import liqudityPoolTool as lpt
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def listingRows():
+    with open(os.path.join(FIXTURES, 'listing_page1.html'), 'rb') as file:
+        return lpt.extractTags(file.read(), {'rows': ('tr', None)}, extractor='stream')['rows'][1:]
+
+
+def test_clean_rejects_empty_cells():
+    assert lpt.clean('$1,234.5') == 1234.5
+    with pytest.raises(ValueError):
+        lpt.clean('')
+    with pytest.raises(ValueError):
+        lpt.clean(None)
+
+
+def test_row_with_empty_cell_is_left_empty():
+    results = [lpt.metricsFromRow(row) for row in listingRows()]
+    assert results[-1] == {'EMP': {}}
+    assert results[0]['BTC']['priceUSD'] == 50000.0
+
+
+def test_market_rows_skip_unscrapable_rows(monkeypatch):
+    monkeypatch.setattr(lpt, '_fetchMarketPage', lambda *args: listingRows())
+    symbols = [symbol for symbol, _ in lpt.iterMarketRows(pages=1, workers=1)]
+    assert symbols == ['BTC', 'ETH', 'AT&T', 'SCR', 'USDT']
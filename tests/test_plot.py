@@ -0,0 +1,47 @@
+# Plotting of csv histories (plot_line(), downsampling)
+import numpy as np
+import pytest
+
+import liqudityPoolTool as lpt
+
+pd = pytest.importorskip('pandas')
+
+
+def test_time_column_is_parsed_and_sorted_chronologically(tmp_path, monkeypatch):
+    csv = tmp_path / 'history.csv'
+    times = ['2026 Jan 05 10:00', '2026 Feb 01 10:00', '2026 Mar 01 10:00', '2026 Jan 20 10:00'] * 50
+    csv.write_text('id,time,token,poolValue\n' + ''.join(f'{i},{t},P,{i}\n' for i, t in enumerate(times)))
+
+    rendered = {}
+    monkeypatch.setattr(lpt, 'renderLine', lambda x, y, fileName, **kwargs: rendered.update(x=x, y=y))
+    lpt.main(['plot', str(csv), 'time', 'poolValue', '--points', '20', '--out', str(tmp_path / 'x.png')])
+
+    x = rendered['x']
+    assert np.issubdtype(x.dtype, np.datetime64)
+    assert len(x) <= 20
+    assert (np.diff(x.astype(np.int64)) >= 0).all()
+    assert x[0] == np.datetime64('2026-01-05T10:00') and x[-1] == np.datetime64('2026-03-01T10:00')
+
+
+def test_plot_renders_png(tmp_path):
+    pytest.importorskip('matplotlib')
+    df = pd.DataFrame({'id': np.arange(1000), 'poolValue': np.sin(np.arange(1000) / 50)})
+    lpt.plot_line(df, 'id', 'poolValue', fileName=str(tmp_path / 'plot.png'), maxPoints=100)
+    assert (tmp_path / 'plot.png').stat().st_size > 0
+
+
+def test_history_series_of_csv_and_store_are_identical(tmp_path):
+    csv = tmp_path / 'history.csv'
+    times = ['2026 Jan %02d 10:00' % day for day in range(1, 31)]
+    csv.write_text('id,time,token,poolValue\n' + ''.join(
+        f'{2 * i},{t},P,{i}\n{2 * i + 1},{t},Q,{-i}\n' for i, t in enumerate(times)))
+    store = lpt.HistoryStore(str(tmp_path / 'history.db'))
+    lpt.migrateCsv(str(csv), store, verbose=False)
+
+    start, end = lpt.datetime(2026, 1, 10, 10), lpt.datetime(2026, 1, 20, 10)
+    x, y = lpt._historySeries(str(csv), 'Q', 'poolValue', start, end)
+    assert y.tolist() == [-i for i in range(9, 19)]
+    xStore, yStore = lpt._historySeries(store, 'Q', 'poolValue', start, end)
+    assert (x.astype('datetime64[s]') == xStore).all() and (y == yStore).all()
+    assert len(lpt._historySeries(str(csv), 'R', 'poolValue')[0]) == 0
+    store.close()
@@ -0,0 +1,56 @@
+# Pool math: vectorized balancePools()/getPoolStatus() against the scalar functions
+import numpy as np
+
+import liqudityPoolTool as lpt
+
+
+def randomPortfolio(n, seed=1):
+    rng = np.random.default_rng(seed)
+    return (rng.lognormal(0, 3, n), rng.lognormal(3, 3, n), rng.lognormal(5, 3, n), rng.lognormal(0, 2, n))
+
+
+def test_balance_pools_matches_scalar_functions():
+    numCol, priceCol, numAss, priceAss = randomPortfolio(20000)
+    amtCol, amtAss, poolVal = lpt.balancePools(numCol, priceCol, numAss, priceAss)
+
+    scalar = np.array([
+        (*lpt.balanceAssets(*args), lpt.getPoolVal(lpt.balanceAssets(*args)[0], args[1],
+                                                   lpt.balanceAssets(*args)[1], args[3]))
+        for args in zip(numCol.tolist(), priceCol.tolist(), numAss.tolist(), priceAss.tolist())
+        ])
+
+    # Only the square can differ (numpy: x * x, Python: pow()), by 1 ulp, see balancePools()
+    for vector, expected in zip([amtCol, amtAss, poolVal], scalar.T):
+        assert (np.abs(vector - expected) <= 2 * np.spacing(expected)).all()
+        assert (vector == expected).mean() > 0.99
+
+
+def test_balance_pools_broadcasts_price_scenarios():
+    numCol, priceCol, numAss, priceAss = randomPortfolio(10)
+    shockedCol = lpt.shockPrices(priceCol, [-0.5, 0.0, 0.5])
+    amtCol, amtAss, poolVal = lpt.balancePools(numCol, shockedCol, numAss, priceAss)
+    assert poolVal.shape == (3, 10)
+    assert (poolVal[1] == lpt.balancePools(numCol, priceCol, numAss, priceAss)[2]).all()
+
+
+def test_table_and_dict_status_are_identical():
+    numCol, priceCol, numAss, priceAss = randomPortfolio(20000, seed=2)
+    data = {
+        'pair%d' % i: {'colStr': 'col%d' % i, 'assStr': 'ass%d' % i, 'numColEntry': nc, 'priceCol': pc,
+                       'numAssEntry': na, 'priceAss': pa}
+        for i, (nc, pc, na, pa) in enumerate(zip(numCol.tolist(), priceCol.tolist(), numAss.tolist(),
+                                                 priceAss.tolist()))
+        }
+    # Pools where np.round() and round() disagree on amtCol, amtAss, poolValue (at roundTo=2)
+    for i, args in enumerate([(808.3667008624175, 0.001139414724418424, 7426223.208479773, 3570.4543246074827),
+                              (106423.36995214633, 4046976.54654167, 246571.23884624615, 0.026328609533568043),
+                              (5649.057966346437, 6911411.410097751, 12.651607451680677, 20.448360733039745)]):
+        data['edge%d' % i] = dict(zip(['numColEntry', 'priceCol', 'numAssEntry', 'priceAss'], args),
+                                  colStr='edgeCol%d' % i, assStr='edgeAss%d' % i)
+    fees = lpt.FeeAccumulator(list(data), feeTier=0.003, poolShare=1.0, now=0)
+    fees.update(vol24h=np.append(priceCol, [0.0] * 3) * 1e4, now=0)
+    fees.update(now=1234.5)
+
+    for roundTo in [0, 2, 4]:
+        asDict = lpt.getPoolStatus(data, roundTo=roundTo, fees=fees)
+        assert lpt.getPoolStatus(lpt.PoolTable.fromDict(data), roundTo=roundTo, fees=fees).toDict() == asDict
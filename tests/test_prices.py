@@ -0,0 +1,56 @@
+# Price providers (PagePriceProvider, StaticPriceProvider) and addPrices()
+import os
+import pytest
+
+import liqudityPoolTool as lpt
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+@pytest.fixture
+def pages(monkeypatch):
+    '''
+    Serves the ethereum fixture for 'ethereum' (and 'dai'), a page without price for 'noprice'
+    and an empty page for 'broken' to getTokenMetrics().
+    '''
+    with open(os.path.join(FIXTURES, 'token_ethereum.html'), 'r') as file:
+        html = file.read()
+    pages = {'ethereum': html, 'dai': html, 'noprice': html.replace('>$2,060.15</span>', '></span>'),
+             'broken': '<html></html>'}
+    monkeypatch.setattr(lpt, 'getTokenMetrics',
+                        lambda tokenStr, **kwargs: lpt.extractTokenMetrics(pages[tokenStr], tokenStr))
+    return pages
+
+
+def test_page_provider_skips_tokens_that_cant_be_parsed(pages):
+    prices = lpt.PagePriceProvider(cache=False).getPrices(['ethereum', 'noprice', 'broken'])
+    assert prices == {'ethereum': 2060.15}
+
+
+@pytest.mark.parametrize('asTable', [False, True])
+def test_add_prices_leaves_out_pairs_without_price(pages, capsys, asTable):
+    data = {
+        'ETH-DAI': {'colStr': 'ethereum', 'assStr': 'dai', 'numColEntry': 1.0, 'numAssEntry': 2000.0},
+        'NOPRICE-DAI': {'colStr': 'noprice', 'assStr': 'dai', 'numColEntry': 1.0, 'numAssEntry': 1.0},
+        'ETH-BROKEN': {'colStr': 'ethereum', 'assStr': 'broken', 'numColEntry': 1.0, 'numAssEntry': 1.0}
+        }
+    if asTable:
+        data = lpt.PoolTable.fromDict(data)
+    priced = lpt.addPrices(data, lpt.PagePriceProvider(cache=False))
+    assert "Couldn't get prices for ['broken', 'noprice']" in capsys.readouterr().out
+
+    status = lpt.getPoolStatus(priced)
+    if asTable:
+        assert priced.keys == ['ETH-DAI'] and list(priced['priceCol']) == [2060.15]
+        status = status.toDict()
+    else:
+        assert list(priced) == ['ETH-DAI'] and priced['ETH-DAI']['priceCol'] == 2060.15
+    assert list(status) == ['ETH-DAI']
+
+
+def test_add_prices_from_static_provider():
+    data = {'ETH-DAI': {'colStr': 'ethereum', 'assStr': 'dai', 'numColEntry': 1.0, 'numAssEntry': 2000.0}}
+    provider = lpt.StaticPriceProvider({'ethereum': 2000.0, 'dai': 1.0})
+    priced = lpt.addPrices(data, provider)
+    assert (priced['ETH-DAI']['priceCol'], priced['ETH-DAI']['priceAss']) == (2000.0, 1.0)
+    assert 'priceCol' not in data['ETH-DAI']
@@ -0,0 +1,38 @@
+# RowIndex: lookups return the first matching row, like findCell()
+import pytest
+
+import liqudityPoolTool as lpt
+
+HTML = '''<table>
+<tr><th>Market Cap</th><td>$1,000</td></tr>
+<tr><th>Market  cap Rank</th><td>#7</td></tr>
+<tr><th>Market Cap</th><td>$2,000</td></tr>
+<tr><th>Trading Volume</th><td>24h $300</td><td>7d $1,500</td></tr>
+<tr><td>no label cells below</td></tr>
+</table>'''
+
+
+@pytest.fixture(params=['bs4', 'stream'])
+def index(request):
+    rows = lpt.extractTags(HTML, {'rows': ('tr', None)}, extractor=request.param)['rows']
+    return lpt.RowIndex(rows)
+
+
+def test_first_row_with_duplicate_label_wins(index):
+    assert index.cell('Market Cap') == 1000
+
+
+def test_exact_label_is_preferred_over_earlier_partial_match(index):
+    assert index.cell('market cap rank') == 7
+
+
+def test_partial_match_returns_first_row_containing_keyword(index):
+    assert index.find('cap')['cells'] == ['$1,000']
+    assert index.cell('Volume', stripToInt=False) == '24h $300'
+    assert index.cell('Volume', '7d') == 71500
+
+
+def test_missing_rows_and_cells_return_none(index):
+    assert index.find('Circulating Supply') is None
+    assert index.cell('Circulating Supply') is None
+    assert index.cell('Volume', '30d') is None
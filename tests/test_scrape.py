@@ -0,0 +1,32 @@
+# Scraping token pages: extractTokenMetrics() errors and createMetricsDict() with workers
+import os
+import pytest
+
+import liqudityPoolTool as lpt
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+POOLS = {'ETH-DAI': {'colStr': 'ethereum', 'assStr': 'dai'}, 'ETH-BAD': {'colStr': 'ethereum', 'assStr': 'nobtc'}}
+
+
+def tokenPage():
+    with open(os.path.join(FIXTURES, 'token_ethereum.html'), 'r') as file:
+        return file.read()
+
+
+def test_missing_btc_price_raises_value_error():
+    html = tokenPage().replace(' data-price-btc="0.0412"', '')
+    with pytest.raises(ValueError, match='priceBTC'):
+        lpt.extractTokenMetrics(html, 'ethereum')
+
+
+def test_create_metrics_dict_skips_pages_that_cant_be_parsed(monkeypatch):
+    pages = {'ethereum': tokenPage(), 'dai': tokenPage(), 'nobtc': tokenPage().replace(' data-price-btc="0.0412"', '')}
+
+    def fetchPage(url, returnResponse=False, **kwargs):
+        body = pages[url.rsplit('/', 1)[-1]].encode()
+        return (200, {}, body) if returnResponse else body
+
+    monkeypatch.setattr(lpt, 'fetchPage', fetchPage)
+    monkeypatch.setattr(lpt, 'TOKEN_CACHE', lpt.TokenCache(ttl=60))
+    metrics = lpt.createMetricsDict(POOLS, verbose=False, workers=2, rateLimit=1000, burst=10)
+    assert list(metrics) == ['ethereum', 'dai']
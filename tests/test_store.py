@@ -0,0 +1,50 @@
+# HistoryStore: queries by token and time range, migrating csvs into empty and non-empty stores
+from datetime import datetime
+
+import liqudityPoolTool as lpt
+
+
+def filledStore(path):
+    store = lpt.HistoryStore(str(path))
+    for t in [100, 200, 300]:
+        store.append([['ETH/USDT', t * 1.0], ['BTC/USDT', t * 2.0]], ['token', 'poolValue'], timestamp=t)
+    return store
+
+
+def test_query_by_token(tmp_path):
+    store = filledStore(tmp_path / 'history.db')
+    df = store.query('ETH/USDT')
+    assert df['token'].unique().tolist() == ['ETH/USDT']
+    assert df['time'].tolist() == [100, 200, 300]
+    assert df['poolValue'].tolist() == [100.0, 200.0, 300.0]
+    assert len(store.query()) == 6
+    store.close()
+
+
+def test_query_by_time_range(tmp_path):
+    store = filledStore(tmp_path / 'history.db')
+
+    # start is included, end isn't
+    df = store.query('BTC/USDT', start=200, end=300)
+    assert df['time'].tolist() == [200]
+    assert df['poolValue'].tolist() == [400.0]
+    assert store.query(start=200)['time'].tolist() == [200, 200, 300, 300]
+    assert store.query(end=datetime.fromtimestamp(200))['time'].tolist() == [100, 100]
+    assert list(store.query(columns=['poolValue']).columns) == ['id', 'time', 'token', 'poolValue']
+    store.close()
+
+
+def test_migrate_keeps_ids_only_in_empty_store(tmp_path):
+    fileName = str(tmp_path / 'pools.csv')
+    lpt.appendRows(fileName, [['ETH/USDT', 1.0], ['BTC/USDT', 2.0]], ['token', 'poolValue'], verbose=False)
+    with open(fileName, 'a') as file:
+        file.write('\n7,2021 Feb 18 17:34,ETH/USDT,3.0')
+
+    store = lpt.HistoryStore(str(tmp_path / 'history.db'))
+    assert lpt.migrateCsv(fileName, store, chunksize=2, verbose=False) == 3
+    assert sorted(store.query()['id']) == [0, 1, 7]
+
+    # Migrating again doesn't collide with the stored ids
+    assert lpt.migrateCsv(fileName, store, verbose=False) == 3
+    assert sorted(store.query()['id']) == [0, 1, 7, 8, 9, 10]
+    store.close()